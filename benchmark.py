@@ -0,0 +1,231 @@
+"""
+Benchmarks the transpiler on generated python programs.
+
+Every case generates a ``main`` function scaled by ``size`` (how many times
+the construct is repeated) and ``depth`` (how deeply it nests), then times
+parsing, emission and writing the output separately and measures the peak
+memory of a whole transpilation. Results are stored as json and can be
+compared against a previous run to catch regressions, including emission
+that grows faster than the input.
+
+usage: python3 benchmark.py [--sizes 100 1000] [--depths 4 16] [--output results.json] [--baseline old.json]
+"""
+
+import os
+import ast
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+from main import Transpiler, __version__
+
+
+def generate_nesting(size: int, depth: int):
+    """Deeply nested for and if blocks"""
+    lines = ["def main():", "    total = 0"]
+    for block in range(size):
+        indent = 1
+        for level in range(depth):
+            if level % 2 == 0:
+                lines.append("    "*indent + f"for i{level} in range({level + 2}):")
+            else:
+                lines.append("    "*indent + f"if i{level - 1} > {block % 3}:")
+            indent += 1
+        lines.append("    "*indent + f"total += i0 * {block}")
+    lines.append("    return total")
+    return "\n".join(lines) + "\n"
+
+
+def generate_attributes(size: int, depth: int):
+    """Long attribute chains, read and assigned"""
+    chain = ".".join(f"field{i}" for i in range(depth))
+    lines = ["def main():"]
+    for block in range(size):
+        lines.append(f"    value{block} = root.{chain}")
+        lines.append(f"    root.{chain} = value{block}")
+    return "\n".join(lines) + "\n"
+
+
+def generate_literals(size: int, depth: int):
+    """Large dict and list literals, ``depth`` * 10 elements each"""
+    count = depth * 10
+    entries = ", ".join(f'"key{i}": {i}' for i in range(count))
+    elements = ", ".join(str(i) for i in range(count))
+    lines = ["def main():"]
+    for block in range(size):
+        lines.append(f"    table{block} = {{{entries}}}")
+        lines.append(f"    array{block} = [{elements}]")
+    return "\n".join(lines) + "\n"
+
+
+def generate_comprehensions(size: int, depth: int):
+    """Many list comprehensions with ``depth`` conditions each"""
+    conditions = " ".join(f"if x > {i}" for i in range(depth))
+    lines = ["def main():", "    items = [1, 2, 3]"]
+    for block in range(size):
+        lines.append(f"    comp{block} = [x * {block} for x in items {conditions}]")
+    return "\n".join(lines) + "\n"
+
+
+def generate_strings(size: int, depth: int):
+    """String building: concatenation chains of ``depth`` pieces, f-strings and loop accumulation"""
+    pieces = " + ".join(f'"p{i}"' for i in range(depth))
+    lines = ["def main():", "    items = [1, 2, 3]"]
+    for block in range(size):
+        lines.append(f"    text{block} = \"\"")
+        lines.append("    for item in items:")
+        lines.append(f"        text{block} += {pieces} + f\"{{item}} of {block}\"")
+    return "\n".join(lines) + "\n"
+
+
+CASES = {
+    "nesting": generate_nesting,
+    "attributes": generate_attributes,
+    "literals": generate_literals,
+    "comprehensions": generate_comprehensions,
+    "strings": generate_strings,
+}
+
+
+def measure(source: str, *, repeat: int, options: dict):
+    """
+    Times the phases of transpiling ``source``, keeping the best of ``repeat``
+    runs. The write phase only writes the finished string to a file, it does
+    not cover the streaming Emitter path of transpile_stream.
+    """
+    parse_time = emit_time = write_time = math.inf
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "output.lua")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            tree = ast.parse(source)
+            parsed = time.perf_counter()
+            output = Transpiler(**options).transpile_ast(tree)
+            emitted = time.perf_counter()
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(output)
+            written = time.perf_counter()
+
+            parse_time = min(parse_time, parsed - start)
+            emit_time = min(emit_time, emitted - parsed)
+            write_time = min(write_time, written - emitted)
+
+    tracemalloc.start()
+    Transpiler(**options).transpile_ast(ast.parse(source))
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    lines = source.count("\n")
+    return {
+        "lines": lines,
+        "nodes": sum(1 for _ in ast.walk(tree)),
+        "output_bytes": len(output),
+        "parse_s": parse_time,
+        "emit_s": emit_time,
+        "write_s": write_time,
+        "lines_per_s": lines / (parse_time + emit_time + write_time),
+        "peak_memory_bytes": peak_memory,
+    }
+
+
+def run(cases, sizes, depths, *, repeat=3, options=None):
+    results = []
+    for case in cases:
+        for depth in depths:
+            for size in sizes:
+                source = CASES[case](size, depth)
+                result = {"case": case, "size": size, "depth": depth}
+                result.update(measure(source, repeat=repeat, options=options or {}))
+                results.append(result)
+                print(f"{case:<15} size={size:<6} depth={depth:<4} lines={result['lines']:<8} "
+                      f"parse={result['parse_s']*1000:9.2f}ms emit={result['emit_s']*1000:9.2f}ms "
+                      f"write={result['write_s']*1000:7.2f}ms {result['lines_per_s']:12.0f} lines/s "
+                      f"peak={result['peak_memory_bytes']/1024/1024:7.2f}MB")
+    return results
+
+
+def check_scaling(results, *, max_exponent=1.5):
+    """
+    Returns a warning for every case whose emission time grows faster than
+    ``nodes ** max_exponent``, where nodes is the size of the ast, between
+    two consecutive sizes at the same depth or two consecutive depths at the
+    same size. Growing with the depth catches emission that redoes work for
+    every enclosing block.
+    """
+    warnings = []
+    for fixed, varied in (("depth", "size"), ("size", "depth")):
+        series = {}
+        for result in results:
+            series.setdefault((result["case"], result[fixed]), []).append(result)
+        for (case, value), points in series.items():
+            points.sort(key=lambda result: result[varied])
+            for smaller, larger in zip(points, points[1:]):
+                if smaller["emit_s"] <= 0 or larger["nodes"] <= smaller["nodes"]:
+                    continue
+                exponent = math.log(larger["emit_s"] / smaller["emit_s"]) / math.log(larger["nodes"] / smaller["nodes"])
+                if exponent > max_exponent:
+                    warnings.append(f"{case} {fixed}={value}: emission grows as nodes^{exponent:.2f} "
+                                    f"from {varied} {smaller[varied]} to {larger[varied]}")
+    return warnings
+
+
+def compare(results, baseline, *, tolerance=0.25, min_time=0.001):
+    """
+    Returns a message for every result whose emission time or peak memory
+    grew by more than ``tolerance`` against its baseline. Parsing is python's
+    own and writing a single f.write, so they are reported but not compared.
+    Emission that grew by less than ``min_time`` seconds is ignored, a
+    relative change of a phase that takes microseconds is noise.
+    """
+    previous = {(result["case"], result["size"], result["depth"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        old = previous.get((result["case"], result["size"], result["depth"]))
+        if old is None:
+            continue
+        for metric in ("emit_s", "peak_memory_bytes"):
+            if metric == "emit_s" and result[metric] - old[metric] < min_time:
+                continue
+            if old[metric] > 0 and result[metric] > old[metric] * (1 + tolerance):
+                regressions.append(f"{result['case']} size={result['size']} depth={result['depth']}: "
+                                   f"{metric} {old[metric]:.6g} -> {result[metric]:.6g} "
+                                   f"(+{(result[metric] / old[metric] - 1)*100:.0f}%)")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the transpiler on generated programs.")
+    parser.add_argument("--cases", nargs="+", choices=sorted(CASES), default=sorted(CASES), help="cases to run, defaults to all")
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 400, 1600], help="how many times each construct is repeated")
+    parser.add_argument("--depths", nargs="+", type=int, default=[4, 16], help="how deeply each construct nests")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per measurement, the fastest one is kept")
+    parser.add_argument("-O", "--optimize", action="store_true", help="benchmark the optimizing transpiler")
+    parser.add_argument("-o", "--output", type=str, default=None, help="write the results to this json file")
+    parser.add_argument("--baseline", type=str, default=None, help="compare against the results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline, 0.25 is 25%%")
+    parser.add_argument("--min-time", type=float, default=0.001, help="ignore slowdowns smaller than this many seconds")
+    args = parser.parse_args()
+
+    results = run(args.cases, args.sizes, args.depths, repeat=args.repeat, options={"optimize": args.optimize})
+    report = {
+        "version": __version__,
+        "python": platform.python_version(),
+        "options": {"optimize": args.optimize},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    problems = check_scaling(results)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            problems += compare(results, json.load(f), tolerance=args.tolerance, min_time=args.min_time)
+    for problem in problems:
+        print("WARNING:", problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
@@ -24,148 +24,857 @@ SOFTWARE.
 
 import os
 import ast
+import hashlib
+import json
+import re
+import bisect
+import math
+import operator
+import itertools
 import sys
+import stat
+import tokenize
 import argparse
+import threading
+import socketserver
+import time
 from typing import List
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 
 
 def convert_constant(node: ast.Constant):
     if isinstance(node.value, str):
-        return f'"{node.value}"'
+        return lua_string(node.value)
     elif isinstance(node.value, bool):
         return str(node.value).lower()
     else:
         return str(node.value)
 
 
-def generate_attribute(node):
-    """Converts attribute ast tree to a form like a.b.c"""
-    if isinstance(node, ast.Attribute):
-        return generate_attribute(node.value) + "." + node.attr
-    elif isinstance(node, ast.Call):
-        if any([kw for kw in node.keywords if (kw.arg == "nc" or kw.arg == "namecall") and bool(kw.value.value) == True]):
-            return unparse_expr(node.func.value) + ":" + node.func.attr + "(" + generate_multiple(node.args) + ")"
-        return unparse_expr(node.func) + "(" + generate_multiple(node.args) + ")"
-    elif isinstance(node, ast.Constant):
-        return str(node.value)
-    else:
-        return node.id
-
-
-def generate_multiple(node):
-    """Seperates tuple with value"""
-    if isinstance(node, ast.Tuple):
-        return ", ".join([generate_multiple(n) for n in node.elts])
-    elif isinstance(node, ast.List):
-        return "[" + generate_multiple(node.elts) + "]"
-    elif isinstance(node, list):
-        return ", ".join([generate_multiple(n) for n in node])
-    elif isinstance(node, ast.Constant):
-        return convert_constant(node)
-    else:
-        return generate_attribute(node)
+def is_func_call(node: ast.Expr, *, func_name: str):
+    if isinstance(node, ast.Call):
+        if isinstance(node.func, ast.Name):
+            return node.func.id == func_name
+        elif isinstance(node.func, ast.Attribute):
+            return node.func.attr == func_name
+    return False
+
+
+# control characters get three digit decimal escapes, a shorter one could absorb a following digit
+LUA_ESCAPES = {code: f"\\{code:03d}" for code in (*range(32), 127)}
+LUA_ESCAPES.update({ord("\\"): "\\\\", ord('"'): '\\"', ord("\n"): "\\n", ord("\r"): "\\r", ord("\t"): "\\t"})
+
+
+def lua_string(value: str):
+    """Quotes ``value`` as a lua string literal"""
+    return '"' + value.translate(LUA_ESCAPES) + '"'
 
 
-def generate_for_loop(node: ast.For):
+def add_operands(node: ast.expr):
+    """Returns the operands of a chain of ``+``, from left to right"""
+    operands = []
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            stack.append(node.right)
+            stack.append(node.left)
+        else:
+            operands.append(node)
+    return operands
+
+
+# the thread parsing deeply nested sources and the process it was started in
+_parse_executor = None
+_parse_pid = None
+_parse_lock = threading.Lock()
+
+
+def parse_source(source: str) -> ast.Module:
+    """
+    ast.parse, with room for deeply nested expressions where the interpreter
+    allows it. 3.9 and 3.10 do not limit the nesting, so they parse sources
+    longer than SHALLOW_SOURCE_SIZE on a thread with a large stack instead of
+    overflowing the C stack. 3.11 and later limit the nesting themselves and
+    raise RecursionError for sources beyond it.
     """
-    Converts python for loop to lua for loop
-    python for loop example:
-    for item in ["hello", "how", "are", "you"]:
-        print(item)
+    if sys.version_info >= (3, 11) or len(source) < SHALLOW_SOURCE_SIZE:
+        return ast.parse(source)
+    return _parse_thread().submit(ast.parse, source).result()
 
-    lua for loop example:
-    for i,v in pairs({"hello", "how", "are", "you"}) do
-        print(v)
-    end
+
+def _parse_thread():
+    """Returns the executor of the parsing thread, starting it with a stack of PARSE_STACK_SIZE on first use"""
+    global _parse_executor, _parse_pid
+    with _parse_lock:
+        # a forked child inherits the executor but not its thread
+        if _parse_executor is None or _parse_pid != os.getpid():
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="parse")
+            stack_size = threading.stack_size(PARSE_STACK_SIZE)
+            try:
+                # the thread starts with the first task and keeps its stack size
+                executor.submit(int).result()
+            finally:
+                threading.stack_size(stack_size)
+            _parse_executor, _parse_pid = executor, os.getpid()
+        return _parse_executor
+
+
+# keywords continuing the compound statement above them from column 0
+CONTINUATION_KEYWORDS = {"else", "elif", "except", "finally"}
+
+
+def top_level_sources(readline):
+    """
+    Splits the source read line by line from ``readline`` into its top level
+    statements, yielding the line number and source of each as soon as the
+    next one starts. Only the lines of the statement being read are kept.
     """
-    for_loop = f"for _,{generate_multiple(node.target)} in pairs({generate_attribute(node.iter)}) do\n"
+    lines = []
+    start = 1
+    logical_start = True
+    decorated = False
+
+    def read():
+        line = readline()
+        if line:
+            lines.append(line)
+        return line
 
-    return for_loop
+    try:
+        for token in tokenize.generate_tokens(read):
+            if token.type == tokenize.NEWLINE:
+                logical_start = True
+                continue
+            if token.type in (tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER):
+                continue
+            if not logical_start:
+                continue
+            logical_start = False
+            row, column = token.start
+            if column != 0:
+                continue
+            if row > start and not decorated and token.string not in CONTINUATION_KEYWORDS:
+                yield start, "".join(lines[:row - start])
+                del lines[:row - start]
+                start = row
+            decorated = token.string == "@"
+    except tokenize.TokenError:
+        # an unterminated statement, parsing the rest reports it like ast.parse does
+        pass
+    if "".join(lines).strip():
+        yield start, "".join(lines)
+
+
+def parse_top_level(readline):
+    """Parses the source read from ``readline`` one top level statement at a time, yielding their ast"""
+    for lineno, source in top_level_sources(readline):
+        try:
+            tree = parse_source(source)
+        except SyntaxError as e:
+            if e.lineno is not None:
+                e.lineno += lineno - 1
+            raise
+        ast.increment_lineno(tree, lineno - 1)
+        yield from tree.body
+
+
+def separated(items, separator):
+    """Interleaves ``items`` with ``separator``, which is a part or a list of parts"""
+    parts = []
+    for item in items:
+        if parts:
+            parts.extend(separator if isinstance(separator, list) else [separator])
+        parts.append(item)
+    return parts
 
 
-list_comp_count = 0
 INDENT = " "*4
-definitions = []
+# stack of the parsing thread on 3.9 and 3.10, enough for hundreds of thousands of nesting levels
+PARSE_STACK_SIZE = 256 * 1024 * 1024
+# sources shorter than this cannot nest deep enough to overflow the stack of any thread on 3.9 and 3.10
+SHALLOW_SOURCE_SIZE = 20000
+# module cache shared by the loaders of a bundle
+BUNDLE_RUNTIME = """local __modules, __loaders = {}, {}
+local function __require(name)
+    local module = __modules[name]
+    if module == nil then
+        -- cached before the loader runs, so circular imports get the module
+        -- being loaded and, as in python, see its names once it is done
+        module = {}
+        __modules[name] = module
+        -- the package is loaded first and holds its submodules as attributes
+        local package, child = string.match(name, "^(.*)%.([^%.]+)$")
+        if package ~= nil and __loaders[package] ~= nil then
+            __require(package)[child] = module
+        end
+        for key, value in pairs(__loaders[name]()) do
+            module[key] = value
+        end
+    end
+    return module
+end
+"""
+# call counters and timers of instrumented functions, __profile_dump()
+# prints and returns a report sorted by the time spent in each function
+INSTRUMENT_RUNTIME = """local __profile, __clock = {}, os.clock
+local function __profile_enter(id, name, line)
+    local record = __profile[id]
+    if record == nil then
+        record = {name = name, line = line, calls = 0, exits = 0, time = 0}
+        __profile[id] = record
+    end
+    record.calls = record.calls + 1
+    return __clock()
+end
+local function __profile_exit(id, start, ...)
+    local record = __profile[id]
+    record.exits = record.exits + 1
+    record.time = record.time + __clock() - start
+    return ...
+end
+function __profile_dump()
+    local records = {}
+    for _, record in pairs(__profile) do
+        records[#records + 1] = record
+    end
+    table.sort(records, function(a, b) return a.time > b.time end)
+    local lines = {}
+    for i, record in ipairs(records) do
+        lines[i] = string.format("%-30s line %-6d %8d calls %8d exits %10.3f ms",
+            record.name, record.line, record.calls, record.exits, record.time * 1000)
+    end
+    local report = table.concat(lines, "\\n")
+    print(report)
+    return report
+end
+"""
+# python operators folded at compile time by ConstantFolder
+FOLDABLE_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+}
+FOLDABLE_COMPARISONS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Is: operator.eq,
+    ast.IsNot: operator.ne,
+    ast.Gt: operator.gt,
+    ast.Lt: operator.lt,
+    ast.GtE: operator.ge,
+    ast.LtE: operator.le,
+}
+CONSTANT_TYPES = (str, int, float, bool, type(None))
+# nodes whose lua code iterates with next, pairs or ipairs
+ITERATING_NODES = (ast.For, ast.comprehension, ast.ImportFrom)
+LUA_KEYWORDS = frozenset([
+    "and", "break", "do", "else", "elseif", "end", "false", "for", "function", "if", "in",
+    "local", "nil", "not", "or", "repeat", "return", "then", "true", "until", "while",
+])
+LUA_TOKEN = re.compile(r"""
+    (?P<space>[ \t\r\f\v]+)
+  | (?P<newline>\n)
+  | (?P<comment>--(?:\[(?P<comment_level>=*)\[[\s\S]*?\](?P=comment_level)\]|[^\n]*))
+  | (?P<string>"(?:\\[\s\S]|[^"\\\n])*"|'(?:\\[\s\S]|[^'\\\n])*'|\[(?P<string_level>=*)\[[\s\S]*?\](?P=string_level)\])
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  | (?P<symbol>\.\.\.|\.\.|==|~=|<=|>=|[\s\S])
+""", re.VERBOSE)
+# characters of the names Minifier gives to locals
+NAME_START = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_"
+NAME_CHARS = NAME_START + "0123456789"
+# lua 5.1 allows 60 upvalues per function and 200 locals per chunk, the pooled strings count towards both
+POOLED_STRINGS_LIMIT = 32
+MERGED_LOCALS_LIMIT = 50
+# format specs string.format understands the same way as python
+FORMAT_SPEC = re.compile(r"[+ #0]*\d*(\.\d+)?[diouxXeEfgGcs]?")
+OPERATORS = {
+    ast.Add: "+",
+    ast.Sub: "-",
+    ast.Mult: "*",
+    ast.Div: "/",
+    ast.FloorDiv: "//",
+    ast.Mod: "%",
+    ast.And: "and",
+    ast.Or: "or",
+    ast.Not: "not ",
+    ast.Eq: "==",
+    ast.NotEq: "~=",
+    ast.Is: "==",
+    ast.Gt: ">",
+    ast.Lt: "<",
+    ast.GtE: ">=",
+    ast.LtE: "<=",
+}
 
 
-def handle_assign(node: ast.Assign, *, is_global=False):
-    global definitions
-    assignation = "local " if not is_global else ""
-    for target in node.targets:
-        if isinstance(target, ast.Name):
-            if target.id in definitions:
-                assignation = unparse_expr(target) + " = "
-            else:
-                assignation += unparse_expr(target) + " = "
-                definitions.append(target.id)
-        elif isinstance(target, ast.Attribute):
-            target = unparse_expr(target)
-            assignation = target + " = "
-    if isinstance(node.value, ast.ListComp):
-        list_comp, comp_name = handle_list_comp(node.value)
-        assignation = list_comp + assignation
-        assignation += comp_name
-    else:
-        assignation += unparse_expr(node.value)
-    return assignation
-
-
-def handle_list_comp(node: ast.ListComp):
-    global list_comp_count
-    comp_name = f"__list_comp_{list_comp_count}"
-    converted_comp = "local " + comp_name + " = {}\n"
-    for generator in node.generators:
-        if isinstance(generator, ast.comprehension):
-            converted_comp += "for _, " + \
-                unparse_expr(generator.target) + " in next, " + \
-                unparse_expr(generator.iter) + " do\n"
-            if len(generator.ifs) > 0:
-                current_indention = 1
-                for if_expr in generator.ifs:
-                    converted_comp += current_indention*INDENT + \
-                        "if " + unparse_expr(if_expr) + " then\n"
-                    current_indention += 1
-
-                converted_comp += INDENT*current_indention + "table.insert(" + comp_name + \
-                    ", " + unparse_expr(node.elt) + ")\n"
-
-                for if_expr in generator.ifs:
-                    current_indention -= 1
-                    converted_comp += current_indention*INDENT + "end\n"
+class Emitter:
+    """
+    Collects generated lua code line by line.
+    Lines are appended to a buffer (or written straight to ``stream`` when
+    one is given), so nested bodies are never copied into their parents.
+    Indentation is kept as state and only applied when a line is written.
+    """
 
-            else:
-                converted_comp += "table.insert(" + comp_name + \
-                    ", " + unparse_expr(node.elt) + ")\n"
+    def __init__(self, stream=None, *, indent=0, source_map: "SourceMap" = None):
+        self._buffer = []
+        self._write = self._buffer.append if stream is None else stream.write
+        self._base = " " * indent
+        self._level = 0
+        self._prefix = self._base
+        # number of utf-8 bytes written so far and the line being written
+        self.size = 0
+        self.lineno = 1
+        self.source_map = source_map
+
+    def indent(self):
+        self._level += 1
+        self._prefix = self._base + INDENT*self._level
+
+    def dedent(self):
+        self._level -= 1
+        self._prefix = self._base + INDENT*self._level
+
+    @contextmanager
+    def indented(self):
+        self.indent()
+        try:
+            yield self
+        finally:
+            self.dedent()
+
+    def write(self, text: str):
+        """Writes raw text without indentation"""
+        self.size += len(text) if text.isascii() else len(text.encode("utf-8"))
+        self.lineno += text.count("\n")
+        self._write(text)
+
+    def line(self, text: str = ""):
+        text = self._prefix + text + "\n"
+        self.size += len(text) if text.isascii() else len(text.encode("utf-8"))
+        self.lineno += 1
+        self._write(text)
+
+    def lines(self, text: str):
+        """Writes every line of a multi line fragment at the current indentation"""
+        # only on newlines, splitlines also breaks string literals holding form feeds and other separators
+        lines = text.split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        for line in lines:
+            self.line(line)
+
+    def getvalue(self):
+        return "".join(self._buffer)
+
+
+class Transpiler:
+    """
+    Converts python source to lua.
+    Every instance keeps its own scope state, so several files can be
+    transpiled in one process. Calls on a single instance are serialized,
+    use one instance per thread to transpile in parallel.
+    """
+
+    def __init__(self, *, optimize=False, tree_shake=False, instrument=False, minify=False, pool_strings=False,
+                 all_definitions=False, profiler: "Profiler" = None):
+        self.optimize = optimize
+        self.tree_shake = tree_shake
+        self.instrument = instrument
+        self.minify = minify
+        self.pool_strings = pool_strings
+        self.all_definitions = all_definitions
+        self.profiler = profiler
+        if profiler is not None:
+            # swapped per instance, so transpiling without a profiler pays nothing for it
+            self.emit_body = self._profiled_emit_body
+        self._lock = threading.Lock()
+        self.reset()
+
+    @property
+    def options(self):
+        """The options changing the generated code, used as part of cache keys"""
+        return {"optimize": self.optimize, "tree_shake": self.tree_shake, "instrument": self.instrument,
+                "minify": self.minify, "pool_strings": self.pool_strings, "all_definitions": self.all_definitions}
+
+    def reset(self):
+        """Forgets every definition made by a previous transpilation"""
+        self.scopes = [set()]
+        # names of every scope known to hold a string
+        self.strings = [set()]
+        # string accumulators of the loops being emitted, mapped to their buffer table
+        self.buffers = {}
+        # facts about the names of the chunk being emitted, see NameAnalysis
+        self.analysis = None
+        # keys of the open scopes in the analysis, the chunk itself is None
+        self.scope_keys = [None]
+        self.list_comp_count = 0
+        self.bundled_modules = set()
+        # ids of the instrumented functions being emitted, innermost last, None inside pcall closures
+        self.profile_ids = []
+        self.profile_count = 0
+
+    def is_defined(self, name: str):
+        return any(name in scope for scope in self.scopes)
+
+    def is_local(self, name: str):
+        """
+        Checks if assigning ``name`` updates a variable the current function
+        already has. Other assignments declare a new local, like python does
+        for every name a function assigns without global or nonlocal.
+        """
+        return name in self.scopes[-1] or (self.analysis is not None and self.analysis.is_declared(self.scope_keys[-1], name))
+
+    def define(self, name: str):
+        self.scopes[-1].add(name)
+
+    def is_string_name(self, name: str):
+        for scope, strings in zip(reversed(self.scopes), reversed(self.strings)):
+            if name in strings:
+                return True
+            elif name in scope:
+                return False
+        return False
+
+    def set_string(self, name: str, is_string: bool):
+        """Records whether the variable ``name`` holds a string after an assignment"""
+        strings = self.strings[-1]
+        for scope, scope_strings in zip(reversed(self.scopes), reversed(self.strings)):
+            if name in scope:
+                strings = scope_strings
+                break
+        if is_string:
+            strings.add(name)
+        else:
+            strings.discard(name)
+
+    def is_string(self, expr: ast.expr):
+        """
+        Checks if ``expr`` is known to evaluate to a string. A sum is a string
+        as soon as one of its operands is, python never adds a string to anything else.
+        """
+        for operand in add_operands(expr):
+            if isinstance(operand, ast.Constant) and isinstance(operand.value, str):
+                return True
+            elif isinstance(operand, ast.JoinedStr):
+                return True
+            elif isinstance(operand, ast.Name) and self.is_string_name(operand.id):
+                return True
+            elif isinstance(operand, ast.Call) and (self.is_str_call(operand) or self.is_join_call(operand)):
+                return True
+        return False
+
+    def is_str_call(self, node: ast.Call):
+        return (isinstance(node.func, ast.Name) and node.func.id == "str" and not self.is_defined("str")
+                and len(node.args) == 1 and not node.keywords)
+
+    def is_join_call(self, node: ast.Call):
+        """Checks for ``separator.join(items)`` on a known string"""
+        return (isinstance(node.func, ast.Attribute) and node.func.attr == "join" and len(node.args) == 1
+                and not node.keywords and self.is_string(node.func.value))
+
+    @contextmanager
+    def scope(self, names=(), strings=(), node: ast.AST = None):
+        """
+        Opens a new function scope, ``names`` are defined inside it and
+        ``strings`` of them hold strings. ``node`` is the function or module of the scope.
+        """
+        self.scopes.append(set(names))
+        self.strings.append(set(strings))
+        self.scope_keys.append(id(node))
+        try:
+            yield
+        finally:
+            self.scopes.pop()
+            self.strings.pop()
+            self.scope_keys.pop()
+
+    def transpile(self, source: str, *, source_map: "SourceMap" = None) -> str:
+        """Transpiles the body of the ``main`` function of ``source``, or all of it with all_definitions"""
+        return self.transpile_ast(parse_source(source), source_map=source_map)
+
+    def transpile_ast(self, tree: ast.Module, *, source_map: "SourceMap" = None) -> str:
+        """Transpiles the body of the ``main`` function of ``tree``, recording line mappings into ``source_map``"""
+        body, _ = self.chunk_body(self.prepare(tree), {})
+        with self._lock:
+            self.reset()
+            out = Emitter(source_map=source_map)
+            out.write(generate_header())
+            self.emit_chunk(body, out)
+            return self.finish(out.getvalue(), source_map)
+
+    def prepare(self, tree: ast.Module) -> ast.Module:
+        """Runs the ast passes enabled by the options over ``tree``, modifying it in place"""
+        if self.optimize:
+            tree = fold_constants(tree)
+        return tree
+
+    def transpile_bundle(self, tree: ast.Module, modules: dict, *, source_map: "SourceMap" = None) -> str:
+        """
+        Transpiles ``tree`` together with the python ``modules`` it imports,
+        a dict of module names to their ast, into a single chunk. Every module
+        becomes a loader function that runs on its first import only.
+        ``source_map`` lists ``tree`` as its first source and every module by name.
+        """
+        tree = self.prepare(tree)
+        modules = {name: self.prepare(module) for name, module in modules.items()}
+        body, modules = self.chunk_body(tree, modules)
+        with self._lock:
+            self.reset()
+            self.bundled_modules = set(modules)
+            out = Emitter(source_map=source_map)
+            out.write(generate_header())
+            self.emit_prologue([*body, *modules.values()], out)
+            out.lines(BUNDLE_RUNTIME)
+            for name, module in modules.items():
+                if source_map is not None:
+                    source_map.use(name)
+                self.emit_module(name, module, out)
+            if source_map is not None:
+                source_map.source = 0
+            self.analysis = NameAnalysis(body)
+            self.emit_body(body, out)
+            return self.finish(out.getvalue(), source_map)
+
+    def transpile_stream(self, statements, stream, *, source_map: "SourceMap" = None):
+        """
+        Transpiles the top level ``statements`` of a module, an iterable such
+        as ``parse_top_level``, writing and flushing the lua of each statement
+        to ``stream`` before the next one is read. Emitted statements are not
+        referenced anymore, so memory stays bounded by the largest of them.
+        Module constants are not propagated and nothing is tree shaken, both
+        need the whole module up front.
+        """
+        with self._lock:
+            self.reset()
+            out = Emitter(stream, source_map=source_map)
+            out.write(generate_header())
+            self.emit_prologue(None, out)
+            # global and nonlocal come before the assignments they affect, so the ones seen so far are enough
+            declared = set()
+            for stmt in self.stream_body(statements):
+                stmts = [stmt]
+                if self.optimize:
+                    stmt = ConstantFolder().visit(stmt)
+                    stmts = [] if stmt is None else stmt if isinstance(stmt, list) else [stmt]
+                # the chunk is not known in full, its functions yet to come could capture any name
+                self.analysis = NameAnalysis(stmts, complete=False, declared=declared)
+                self.emit_body(stmts, out)
+                stream.flush()
+
+    def stream_body(self, statements):
+        """Yields the statements of the chunk one by one, dropping them from the function holding them"""
+        if self.all_definitions:
+            for node in statements:
+                if not is_docstring(node) and not is_main_guard(node):
+                    yield node
+            return
+        for node in statements:
+            if isinstance(node, ast.FunctionDef) and node.name == "main":
+                body = node.body
+                for index, stmt in enumerate(body):
+                    body[index] = None
+                    yield stmt
+                return
+        raise Exception("No main function found in the input file")
+
+    def finish(self, lua: str, source_map: "SourceMap" = None) -> str:
+        """Applies the passes over the generated lua of a whole chunk"""
+        if self.minify:
+            return minify(lua, pool_strings=self.pool_strings, source_map=source_map)
+        return lua
+
+    def chunk_body(self, tree: ast.Module, modules: dict):
+        """
+        Returns the statements making up the chunk of ``tree`` and the
+        ``modules`` it uses: the body of ``main``, or with all_definitions
+        every top level statement
+        """
+        if self.all_definitions:
+            return top_level_body(tree), modules
+        return self.shake(find_main(tree), modules)
+
+    def shake(self, root: ast.FunctionDef, modules: dict):
+        """
+        Returns the body of ``root`` and the ``modules`` it uses, without the
+        definitions nothing reaches when tree shaking is enabled
+        """
+        if not self.tree_shake:
+            return root.body, modules
+        return TreeShaker(root, modules).shake()
+
+    def emit_prologue(self, body: List[ast.AST], out: "Emitter"):
+        """Writes the locals a chunk made of ``body`` needs up front, all of them when ``body`` is not known yet"""
+        if self.optimize and (body is None or any(isinstance(node, ITERATING_NODES) for stmt in body for node in ast.walk(stmt))):
+            # generic for loops then read the iterator functions from upvalues
+            # instead of looking them up in the globals table
+            out.line("local next, pairs, ipairs = next, pairs, ipairs")
+        if self.instrument:
+            out.lines(INSTRUMENT_RUNTIME)
+
+    def emit_chunk(self, body: List[ast.AST], out: "Emitter"):
+        """Writes the lua code for the statements of a whole chunk into ``out``"""
+        self.analysis = NameAnalysis(body)
+        self.emit_prologue(body, out)
+        self.emit_body(body, out)
+
+    def emit_module(self, name: str, tree: ast.Module, out: "Emitter"):
+        """Writes the loader of a bundled module, which returns a table of its top level names"""
+        body = top_level_body(tree)
+        # plain function definitions are global in lua, declare them local to the module first
+        functions = [node.name for node in body if isinstance(node, ast.FunctionDef) and not decorator_names(node)]
+        out.line(f'__loaders["{name}"] = function()')
+        self.analysis = NameAnalysis(body, tree)
+        with out.indented(), self.scope(functions, node=tree):
+            if functions:
+                out.line("local " + ", ".join(functions))
+            self.emit_body(body, out)
+            out.line("return {" + ", ".join(f"{export} = {export}" for export in module_exports(body)) + "}")
+        out.line("end")
+
+    def generate_require(self, module: str):
+        """Returns the expression loading ``module``, from the bundle if it is part of it"""
+        if module in self.bundled_modules:
+            return f'__require("{module}")'
+        return f"require('{module}.lua')"
+
+    def generate_attribute(self, node):
+        """Converts attribute ast tree to a form like a.b.c"""
+        return self.render((Transpiler._attribute_parts, node))
+
+    def _attribute_parts(self, node):
+        if isinstance(node, ast.Attribute):
+            return [(Transpiler._attribute_parts, node.value), "." + node.attr]
+        elif isinstance(node, ast.Call):
+            if any([kw for kw in node.keywords if (kw.arg == "nc" or kw.arg == "namecall") and bool(kw.value.value) == True]):
+                return [node.func.value, ":" + node.func.attr + "(", (Transpiler._multiple_parts, node.args), ")"]
+            return [node.func, "(", (Transpiler._multiple_parts, node.args), ")"]
+        elif isinstance(node, ast.Constant):
+            return str(node.value)
+        else:
+            return node.id
+
+    def generate_multiple(self, node):
+        """Seperates tuple with value"""
+        return self.render((Transpiler._multiple_parts, node))
+
+    def _multiple_parts(self, node):
+        if isinstance(node, ast.Tuple):
+            return separated([(Transpiler._multiple_parts, n) for n in node.elts], ", ")
+        elif isinstance(node, ast.List):
+            return ["[", (Transpiler._multiple_parts, node.elts), "]"]
+        elif isinstance(node, list):
+            return separated([(Transpiler._multiple_parts, n) for n in node], ", ")
+        elif isinstance(node, ast.Constant):
+            return convert_constant(node)
+        else:
+            return [(Transpiler._attribute_parts, node)]
+
+    def generate_for_loop(self, node: ast.For):
+        """
+        Converts python for loop to lua for loop
+        python for loop example:
+        for item in ["hello", "how", "are", "you"]:
+            print(item)
+
+        lua for loop example:
+        for i,v in pairs({"hello", "how", "are", "you"}) do
+            print(v)
+        end
+        """
+        for_loop = f"for _,{self.generate_multiple(node.target)} in pairs({self.generate_attribute(node.iter)}) do\n"
+
+        return for_loop
+
+
+    def handle_assign(self, node: ast.Assign, *, is_global=False):
+        assignation = "local " if not is_global else ""
+        is_string = self.is_string(node.value)
+        for target in node.targets:
+            if isinstance(target, ast.Name):
+                if self.is_local(target.id):
+                    assignation = self.unparse_expr(target) + " = "
+                else:
+                    assignation += self.unparse_expr(target) + " = "
+                    self.define(target.id)
+                self.set_string(target.id, is_string)
+            elif isinstance(target, ast.Attribute):
+                target = self.unparse_expr(target)
+                assignation = target + " = "
+        if isinstance(node.value, ast.ListComp):
+            list_comp, comp_name = self.handle_list_comp(node.value)
+            assignation = list_comp + assignation
+            assignation += comp_name
+        elif isinstance(node.value, ast.Call) and self.is_join_call(node.value) and isinstance(node.value.args[0], ast.ListComp):
+            # the comprehension is built first, then joined like any other list
+            list_comp, comp_name = self.handle_list_comp(node.value.args[0])
+            assignation = list_comp + assignation
+            assignation += self.unparse_expr(ast.Call(node.value.func, [ast.Name(comp_name, ast.Load())], []))
+        else:
+            assignation += self.unparse_expr(node.value)
+        return assignation
+
+
+    def handle_list_comp(self, node: ast.ListComp):
+        comp_name = f"__list_comp_{self.list_comp_count}"
+        if self.optimize:
+            # a running counter avoids the global lookup and call of table.insert
+            counter = comp_name + "_n"
+            converted_comp = "local " + comp_name + ", " + counter + " = {}, 0\n"
+            append = [counter + " = " + counter + " + 1",
+                      comp_name + "[" + counter + "] = " + self.unparse_expr(node.elt)]
+        else:
+            converted_comp = "local " + comp_name + " = {}\n"
+            append = ["table.insert(" + comp_name + ", " + self.unparse_expr(node.elt) + ")"]
+        for generator in node.generators:
+            if isinstance(generator, ast.comprehension):
+                converted_comp += "for _, " + \
+                    self.unparse_expr(generator.target) + " in " + \
+                    self.generate_iterator(generator.iter) + " do\n"
+                if len(generator.ifs) > 0:
+                    current_indention = 1
+                    for if_expr in generator.ifs:
+                        converted_comp += current_indention*INDENT + \
+                            "if " + self.unparse_expr(if_expr) + " then\n"
+                        current_indention += 1
+
+                    for line in append:
+                        converted_comp += INDENT*current_indention + line + "\n"
+
+                    for if_expr in generator.ifs:
+                        current_indention -= 1
+                        converted_comp += current_indention*INDENT + "end\n"
+
+                else:
+                    for line in append:
+                        converted_comp += line + "\n"
+
+                converted_comp += "end\n"
+        self.list_comp_count += 1
+        return converted_comp, comp_name
+
+    def generate_iterator(self, node: ast.expr):
+        """
+        Converts the iterable of a for loop to the explist of a lua generic for.
+        With optimize list literals are walked in order with ipairs.
+        """
+        if self.optimize and isinstance(node, ast.List):
+            return "ipairs(" + self.unparse_expr(node) + ")"
+        return "next, " + self.unparse_expr(node)
+
+
+    def unparse_expr(self, expr: ast.Expr, *, indent=0):
+        return self.render(expr)
+
+    def render(self, item):
+        """
+        Converts an expression to lua without recursing into its children.
+        Handlers return either the finished string or a list of parts: strings,
+        child nodes, nested lists and ``(function, node)`` pairs expanded by
+        ``function``.
+        Parts are expanded with an explicit stack and joined once, so deep
+        expressions take linear time and cannot exhaust the recursion limit.
+        With a profiler every node is timed until the last of its parts is expanded.
+        """
+        handlers = self.expr_handlers
+        profiler = self.profiler
+        depth = profiler.depth if profiler is not None else 0
+        parts = []
+        stack = [item]
+        try:
+            while stack:
+                item = stack.pop()
+                if isinstance(item, str):
+                    parts.append(item)
+                    continue
+                elif isinstance(item, list):
+                    stack.extend(reversed(item))
+                    continue
+                elif isinstance(item, ast.AST):
+                    handler = handlers.get(type(item)) or self._find_handler(handlers, item)
+                    if profiler is not None:
+                        profiler.enter(item)
+                        stack.append((Transpiler._profile_exit, item))
+                    result = handler(self, item)
+                else:
+                    function, node = item
+                    result = function(self, node)
+                if isinstance(result, str):
+                    parts.append(result)
+                else:
+                    stack.extend(reversed(result))
+        finally:
+            # a handler that raised leaves the nodes being expanded open
+            while profiler is not None and profiler.depth > depth:
+                profiler.exit()
+        return "".join(parts)
+
+    def _profile_exit(self, node: ast.AST):
+        self.profiler.exit()
+        return ""
+
+    @staticmethod
+    def _find_handler(handlers: dict, node):
+        """
+        Looks up the handler of a node type that is not registered directly,
+        going through its base classes. The result is cached in ``handlers``.
+        """
+        for node_type in type(node).__mro__:
+            if node_type in handlers:
+                handlers[type(node)] = handlers[node_type]
+                return handlers[node_type]
+        raise NotImplementedError(node)
 
-            converted_comp += "end\n"
-    list_comp_count += 1
-    return converted_comp, comp_name
+    @classmethod
+    def register_expr(cls, node_type: type, handler):
+        """
+        Registers ``handler(transpiler, node)`` for expressions of ``node_type``.
+        It returns the lua string or a list of parts, see render.
+        """
+        if "expr_handlers" not in cls.__dict__:
+            cls.expr_handlers = dict(cls.expr_handlers)
+        cls.expr_handlers[node_type] = handler
 
+    @classmethod
+    def register_stmt(cls, node_type: type, handler):
+        """Registers ``handler(transpiler, node, out)`` for statements of ``node_type``"""
+        if "stmt_handlers" not in cls.__dict__:
+            cls.stmt_handlers = dict(cls.stmt_handlers)
+        cls.stmt_handlers[node_type] = handler
 
-def unparse_expr(expr: ast.Expr, *, indent=0):
-    indent = " " * indent
-    if isinstance(expr, ast.Call):
-        if isinstance(expr.func, ast.Name):
-            return expr.func.id + "(" + ",".join([unparse_expr(arg) for arg in expr.args]) + ")"
+    def _unparse_call(self, expr: ast.Call):
+        if self.is_str_call(expr):
+            return ["tostring(", expr.args[0], ")"]
+        elif self.is_join_call(expr):
+            separator = expr.func.value
+            if isinstance(separator, ast.Constant) and separator.value == "":
+                return ["table.concat(", expr.args[0], ")"]
+            return ["table.concat(", expr.args[0], ", ", separator, ")"]
+        elif isinstance(expr.func, ast.Name):
+            return [expr.func.id + "(", *separated(expr.args, ","), ")"]
         elif isinstance(expr.func, ast.Attribute):
             if any([kw for kw in expr.keywords if (kw.arg == "nc" or kw.arg == "namecall") and bool(kw.value.value) == True]):
-                return unparse_expr(expr.func.value) + ":" + expr.func.attr + "(" + ",".join([unparse_expr(arg) for arg in expr.args]) + ")"
+                return [expr.func.value, ":" + expr.func.attr + "(", *separated(expr.args, ","), ")"]
             else:
-                return unparse_expr(expr.func.value) + "." + expr.func.attr + "(" + ",".join([unparse_expr(arg) for arg in expr.args]) + ")"
-    elif isinstance(expr, ast.Name):
+                return [expr.func.value, "." + expr.func.attr + "(", *separated(expr.args, ","), ")"]
+        raise NotImplementedError(expr)
+
+    def _unparse_name(self, expr: ast.Name):
         return expr.id
-    elif isinstance(expr, ast.Attribute):
-        return generate_attribute(expr)
-    elif isinstance(expr, ast.Tuple):
-        return generate_multiple(expr)
-    elif isinstance(expr, ast.Num):
-        return str(expr.n)
-    elif isinstance(expr, ast.List):
-        return "{" + ",".join([unparse_expr(e) for e in expr.elts]) + "}"
-    elif isinstance(expr, ast.Constant):
+
+    def _unparse_list(self, expr: ast.List):
+        return ["{", *separated(expr.elts, ","), "}"]
+
+    def _unparse_constant(self, expr: ast.Constant):
         if isinstance(expr.value, str):
-            return '"' + expr.value + '"'
+            return lua_string(expr.value)
         elif isinstance(expr.value, bool):
             return str(expr.value).lower()
         elif expr.value is None:
@@ -173,252 +882,1960 @@ def unparse_expr(expr: ast.Expr, *, indent=0):
         else:
             return str(expr.value)
 
-        return f"\"{expr.value}\""
-    elif isinstance(expr, ast.Compare):
-        return unparse_expr(expr.left) + " " + " ".join([unparse_expr(op) for op in expr.ops]) + " " + unparse_expr(expr.comparators[0])
-    elif isinstance(expr, ast.NotEq):
-        return "~="
-    elif isinstance(expr, ast.Eq):
-        return "=="
-    elif isinstance(expr, ast.BinOp):
-        return unparse_expr(expr.left) + " " + unparse_expr(expr.op) + " " + unparse_expr(expr.right)
-    elif isinstance(expr, ast.Mod):
-        return "%"
-    elif isinstance(expr, ast.BoolOp):
-        if isinstance(expr.op, ast.And):
-            converted = []
-            for v in expr.values:
-                converted.append(unparse_expr(v))
-                converted.append("and")
-
-            converted.pop(-1)
-            return "(" + " ".join(converted) + ")"
-        elif isinstance(expr.op, ast.Or):
-            converted = []
-            for v in expr.values:
-                converted.append(unparse_expr(v))
-                converted.append("or")
-
-            converted.pop(-1)
-            return "(" + " ".join(converted) + ")"
-    elif isinstance(expr, ast.UnaryOp):
-        return unparse_expr(expr.op) + unparse_expr(expr.operand)
-    elif isinstance(expr, ast.Not):
-        return "not "
-    elif isinstance(expr, ast.Is):
-        return "=="
-    elif isinstance(expr, ast.Pass):
+    def _unparse_compare(self, expr: ast.Compare):
+        return [expr.left, " ", *separated(expr.ops, " "), " ", expr.comparators[0]]
+
+    def _unparse_binop(self, expr: ast.BinOp):
+        if isinstance(expr.op, ast.Add):
+            # a whole chain of + is either numbers or strings
+            operands = add_operands(expr)
+            if self.is_string(expr):
+                return separated(operands, " .. ")
+            return separated(operands, [" ", expr.op, " "])
+        return [expr.left, " ", expr.op, " ", expr.right]
+
+    def _unparse_joined_str(self, expr: ast.JoinedStr):
+        """Converts an f-string to a string.format call"""
+        format_string = ""
+        args = []
+        for value in expr.values:
+            if isinstance(value, ast.Constant):
+                format_string += value.value.replace("%", "%%")
+                continue
+            if value.conversion not in (-1, ord("s")):
+                # !r and !a quote strings the python way, lua has no such format
+                raise NotImplementedError(value)
+            spec = "s"
+            if value.format_spec is not None:
+                if not all(isinstance(part, ast.Constant) for part in value.format_spec.values):
+                    raise NotImplementedError(value)
+                spec = "".join(part.value for part in value.format_spec.values)
+                if not FORMAT_SPEC.fullmatch(spec):
+                    raise NotImplementedError(value)
+                if not spec[-1:].isalpha():
+                    spec += "s"
+            format_string += "%" + spec
+            if spec.endswith("s") and not self.is_string(value.value):
+                # lua 5.1 only formats strings and numbers with %s
+                args.append(["tostring(", value.value, ")"])
+            else:
+                args.append(value.value)
+        if not args:
+            return lua_string(format_string.replace("%%", "%"))
+        elif format_string == "%s":
+            return [args[0]]
+        return ["string.format(", lua_string(format_string), ", ", *separated(args, ", "), ")"]
+
+    def _unparse_boolop(self, expr: ast.BoolOp):
+        return ["(", *separated(expr.values, [" ", expr.op, " "]), ")"]
+
+    def _unparse_unaryop(self, expr: ast.UnaryOp):
+        return [expr.op, expr.operand]
+
+    def _unparse_operator(self, expr: ast.AST):
+        return OPERATORS[type(expr)]
+
+    def _unparse_pass(self, expr: ast.Pass):
         return ""
-    elif isinstance(expr, ast.Return):
-        return "return " + unparse_expr(expr.value)
-    elif isinstance(expr, ast.Gt):
-        return ">"
-    elif isinstance(expr, ast.Lt):
-        return "<"
-    elif isinstance(expr, ast.GtE):
-        return ">="
-    elif isinstance(expr, ast.LtE):
-        return "<="
-    elif isinstance(expr, ast.Await):
-        args = [unparse_expr(arg) for arg in expr.value.args]
-        return f"coroutine.resume({unparse_expr(expr.value.func) + (', '+','.join(args) if len(args) > 0 else '')})"
-    elif isinstance(expr, ast.Lambda):
-        return "function(" + ", ".join([arg.arg for arg in expr.args.args]) + ") " + unparse_expr(expr.body) + " end"
-    elif isinstance(expr, ast.Add):
-        return "+"
-    elif isinstance(expr, ast.Sub):
-        return "-"
-    elif isinstance(expr, ast.Mult):
-        return "*"
-    elif isinstance(expr, ast.Div):
-        return "/"
-    elif isinstance(expr, ast.FloorDiv):
-        return "//"
-    elif isinstance(expr, ast.Dict):
-        return "{" + ", ".join(["["+unparse_expr(key)+"]" + " = " + unparse_expr(value) for key, value in zip(expr.keys, expr.values)]) + "}"
-    elif isinstance(expr, ast.Set):
-        return "{" + ", ".join([unparse_expr(e) for e in expr.elts]) + "}"
-    else:
-        raise NotImplementedError(expr)
 
+    def _unparse_return(self, expr: ast.Return):
+        return ["return ", expr.value]
 
-def handle_test(node: ast.Compare):
-    return unparse_expr(node.left) + " " + " ".join([unparse_expr(op) for op in node.ops]) + " " + unparse_expr(node.comparators[0])
+    def _unparse_await(self, expr: ast.Await):
+        args = [", ", *separated(expr.value.args, ",")] if len(expr.value.args) > 0 else []
+        return ["coroutine.resume(", expr.value.func, *args, ")"]
 
+    def _unparse_lambda(self, expr: ast.Lambda):
+        return ["function(" + ", ".join([arg.arg for arg in expr.args.args]) + ") ", expr.body, " end"]
 
-def is_func_call(node: ast.Expr, *, func_name: str):
-    if isinstance(node, ast.Call):
-        if isinstance(node.func, ast.Name):
-            return node.func.id == func_name
-        elif isinstance(node.func, ast.Attribute):
-            return node.func.attr == func_name
-    return False
+    def _unparse_dict(self, expr: ast.Dict):
+        return ["{", *separated([["[", key, "] = ", value] for key, value in zip(expr.keys, expr.values)], ", "), "}"]
 
+    def _unparse_set(self, expr: ast.Set):
+        return ["{", *separated(expr.elts, ", "), "}"]
 
-def handle_body(body: List[ast.AST], *, indent=0):
-    generated_code = ""
-    indent = " " * indent
-    for node in body:
-        if isinstance(node, ast.Assign):
-            generated_code += indent + handle_assign(node) + "\n"
-        elif isinstance(node, ast.For):
+    expr_handlers = {
+        ast.Call: _unparse_call,
+        ast.Name: _unparse_name,
+        ast.Attribute: _attribute_parts,
+        ast.Tuple: _multiple_parts,
+        ast.List: _unparse_list,
+        ast.Constant: _unparse_constant,
+        ast.Compare: _unparse_compare,
+        ast.BinOp: _unparse_binop,
+        ast.BoolOp: _unparse_boolop,
+        ast.UnaryOp: _unparse_unaryop,
+        ast.Pass: _unparse_pass,
+        ast.Return: _unparse_return,
+        ast.Await: _unparse_await,
+        ast.Lambda: _unparse_lambda,
+        ast.Dict: _unparse_dict,
+        ast.Set: _unparse_set,
+        ast.JoinedStr: _unparse_joined_str,
+        **dict.fromkeys(OPERATORS, _unparse_operator),
+    }
+
+
+    def handle_test(self, node: ast.Compare):
+        return self.unparse_expr(node.left) + " " + " ".join([self.unparse_expr(op) for op in node.ops]) + " " + self.unparse_expr(node.comparators[0])
+
+
+    def handle_body(self, body: List[ast.AST], *, indent=0):
+        """Converts a list of statements to lua code and returns it as a string"""
+        out = Emitter(indent=indent)
+        self.emit_body(body, out)
+        return out.getvalue()
+
+
+    def emit_body(self, body: List[ast.AST], out: "Emitter"):
+        """Writes the lua code for a list of statements into ``out``"""
+        handlers = self.stmt_handlers
+        source_map = out.source_map
+        for node in body:
+            handler = handlers.get(type(node)) or self._find_handler(handlers, node)
+            if source_map is not None:
+                source_map.add(out.lineno, node)
+            handler(self, node, out)
+
+    def _profiled_emit_body(self, body: List[ast.AST], out: "Emitter"):
+        handlers = self.stmt_handlers
+        profiler = self.profiler
+        source_map = out.source_map
+        profiler.body_depth += 1
+        try:
+            for node in body:
+                handler = handlers.get(type(node)) or self._find_handler(handlers, node)
+                if source_map is not None:
+                    source_map.add(out.lineno, node)
+                size = out.size
+                profiler.call(node, handler, self, node, out)
+                if profiler.body_depth == 1 and isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    profiler.functions[node.name] = profiler.functions.get(node.name, 0) + out.size - size
+        finally:
+            profiler.body_depth -= 1
 
+    def _emit_assign(self, node: ast.Assign, out: Emitter):
+        out.lines(self.handle_assign(node))
+
+    def _emit_for(self, node: ast.For, out: Emitter):
+        with self.string_buffers(node, out):
             # if there is only one target, use it directly
             if not isinstance(node.target, ast.Tuple):
                 if is_func_call(node.iter, func_name="range"):
                     if len(node.iter.args) == 1:
-                        generated_code += indent + \
-                            f"for {unparse_expr(node.target)}=1, {unparse_expr(node.iter.args[0])} do\n"""
+                        out.line(f"for {self.unparse_expr(node.target)}=1, {self.unparse_expr(node.iter.args[0])} do")
                     elif len(node.iter.args) == 2:
-                        generated_code += indent + \
-                            f"for {unparse_expr(node.target)}={unparse_expr(node.iter.args[0])}, {unparse_expr(node.iter.args[1])} do\n"""
+                        out.line(f"for {self.unparse_expr(node.target)}={self.unparse_expr(node.iter.args[0])}, {self.unparse_expr(node.iter.args[1])} do")
                     elif len(node.iter.args) == 3:
-                        generated_code += indent + \
-                            f"for {unparse_expr(node.target)}={unparse_expr(node.iter.args[0])}, {unparse_expr(node.iter.args[1])}, {unparse_expr(node.iter.args[2])} do\n"""
+                        out.line(f"for {self.unparse_expr(node.target)}={self.unparse_expr(node.iter.args[0])}, {self.unparse_expr(node.iter.args[1])}, {self.unparse_expr(node.iter.args[2])} do")
+                elif self.optimize and isinstance(node.iter, ast.ListComp):
+                    comp, comp_name = self.handle_list_comp(node.iter)
+                    out.lines(comp)
+                    out.line(f"for {comp_name}_i=1, #{comp_name} do")
+                    out.line(f"{INDENT}local {self.unparse_expr(node.target)} = {comp_name}[{comp_name}_i]")
                 else:
-                    generated_code += indent + \
-                        f"for _, {unparse_expr(node.target)} in next, {unparse_expr(node.iter)} do\n"
+                    out.line(f"for _, {self.unparse_expr(node.target)} in {self.generate_iterator(node.iter)} do")
 
             # if there are more than 1 target take tuple
             elif isinstance(node.target, ast.Tuple):
                 if isinstance(node.iter, ast.Call) and isinstance(node.iter.func, ast.Name) and node.iter.func.id == "enumerate":
-                    generated_code += indent + \
-                        f"for {unparse_expr(node.target)} in pairs({unparse_expr(node.iter.args[0])}) do\n"
+                    out.line(f"for {self.unparse_expr(node.target)} in pairs({self.unparse_expr(node.iter.args[0])}) do")
                 else:
-                    generated_code += indent + \
-                        f"for {unparse_expr(node.target)} in {unparse_expr(node.iter)} do\n"
-
-            generated_code += indent + handle_body(node.body, indent=4)
-            generated_code += indent + "end\n"
-        elif isinstance(node, ast.Expr):
-            if isinstance(node, ast.ListComp):
-                comp, name = handle_list_comp(node)
-                generated_code += indent + comp + "\n"
+                    out.line(f"for {self.unparse_expr(node.target)} in {self.unparse_expr(node.iter)} do")
+
+            # the loop variables are fresh locals
+            targets = [node.target] if isinstance(node.target, ast.Name) else ast.walk(node.target)
+            for target in targets:
+                if isinstance(target, ast.Name):
+                    self.set_string(target.id, False)
+            with out.indented():
+                self.emit_body(node.body, out)
+            out.line("end")
+
+    def _emit_expr(self, node: ast.Expr, out: Emitter):
+        out.line(self.unparse_expr(node.value))
+
+    def _emit_if(self, node: ast.If, out: Emitter):
+        out.line("if " + self.unparse_expr(node.test) + " then")
+        with out.indented():
+            self.emit_body(node.body, out)
+        if node.orelse:
+            # elif is parsed as an else holding a single if
+            if len(node.orelse) == 1 and isinstance(node.orelse[0], ast.If):
+                orelse = node.orelse[0]
+                out.line(f"elseif {self.unparse_expr(orelse.test)} then")
+                with out.indented():
+                    self.emit_body(orelse.body, out)
+                if orelse.orelse:
+                    out.line("else")
+                    with out.indented():
+                        self.emit_body(orelse.orelse, out)
             else:
-                generated_code += indent + unparse_expr(node.value) + "\n"
-        elif isinstance(node, ast.If):
-            generated_code += indent + "if " + \
-                unparse_expr(node.test) + " then\n"
-            generated_code += indent + handle_body(node.body, indent=4)
-            if node.orelse:
-                if isinstance(node.orelse, list):
-
-                    for orelse in node.orelse:
-                        generated_code += indent + \
-                            f"elseif {unparse_expr(orelse.test)} then\n"
-                        generated_code += indent + \
-                            handle_body(orelse.body, indent=4)
-                        if orelse.orelse:
-                            generated_code += indent + "else\n"
-                            generated_code += indent + \
-                                handle_body(orelse.orelse, indent=4)
-                elif isinstance(node.orelse, ast.If):
-                    generated_code += indent + "elseif " + \
-                        unparse_expr(node.orelse.test) + " then\n"
-                    generated_code += indent + \
-                        handle_body(node.orelse.body, indent=4)
+                out.line("else")
+                with out.indented():
+                    self.emit_body(node.orelse, out)
+        out.line("end")
+
+    def _emit_while(self, node: ast.While, out: Emitter):
+        with self.string_buffers(node, out):
+            out.line("while " + self.unparse_expr(node.test) + " do")
+            with out.indented():
+                self.emit_body(node.body, out)
+            out.line("end")
+
+    def loop_accumulators(self, node: ast.AST):
+        """
+        Returns the string variables a loop only ever extends with ``+=``.
+        They are not read anywhere else in the loop, so their pieces can be
+        collected in a table and joined once the loop is done. A function
+        called in the loop could read them too, unless none of the functions
+        of the scope captures them.
+        """
+        analysis = self.analysis
+        if analysis is None or not analysis.has_range(node):
+            # a loop emitted on its own through handle_body
+            analysis = NameAnalysis([node], complete=False)
+        if analysis.exits(node):
+            # the join after the loop would be skipped
+            return []
+        calls = analysis.calls(node, str_calls=self.is_defined("str"))
+        accumulators = []
+        for name in analysis.appended(node):
+            if name in accumulators or name in self.buffers or analysis.uses(node, name) or not self.is_string_name(name):
+                continue
+            if calls and analysis.captures(self.scope_keys[-1], name):
+                continue
+            accumulators.append(name)
+        return accumulators
+
+    @contextmanager
+    def string_buffers(self, node: ast.AST, out: Emitter):
+        """
+        Turns the string accumulators of a loop into buffer tables joined after
+        it, repeated concatenation copies the whole string on every iteration
+        """
+        buffers = {name: f"__{name}_buffer" for name in self.loop_accumulators(node)}
+        for name, buffer in buffers.items():
+            out.line(f"local {buffer} = {{{name}}}")
+        self.buffers.update(buffers)
+        try:
+            yield
+        finally:
+            for name in buffers:
+                del self.buffers[name]
+        for name, buffer in buffers.items():
+            out.line(f"{name} = table.concat({buffer})")
+
+    def _emit_pass(self, node: ast.Pass, out: Emitter):
+        pass
+
+    def _emit_global(self, node: ast.Global, out: Emitter):
+        # only changes how assignments are emitted, see is_local
+        pass
+
+    def _emit_return(self, node: ast.Return, out: Emitter):
+        # None while emitting a pcall closure, its return does not leave the function
+        if self.profile_ids and self.profile_ids[-1] is not None:
+            values = ", " + self.unparse_expr(node.value) if node.value is not None else ""
+            out.line(f"return __profile_exit({self.profile_ids[-1]}, __start{values})")
+        else:
+            out.line("return " + self.unparse_expr(node.value))
+
+    @contextmanager
+    def function_body(self, node: ast.FunctionDef, out: Emitter):
+        """Surrounds the body of a function with the entry and exit counters of instrument"""
+        if not self.instrument:
+            yield
+            return
+        self.profile_count += 1
+        profile_id = self.profile_count
+        out.line(f'local __start = __profile_enter({profile_id}, "{node.name}", {node.lineno})')
+        self.profile_ids.append(profile_id)
+        try:
+            yield
+        finally:
+            self.profile_ids.pop()
+        # a return has to be the last statement of a block
+        if not (node.body and isinstance(node.body[-1], ast.Return)):
+            out.line(f"__profile_exit({profile_id}, __start)")
+
+    def _emit_function_def(self, node: ast.FunctionDef, out: Emitter):
+        if "anon" in (dec.id for dec in node.decorator_list) and "local" in (dec.id for dec in node.decorator_list):
+            out.line(f"local {node.name} = function" + "(" + ", ".join([arg.arg for arg in node.args.args]) + ")")
+        elif "local" in (dec.id for dec in node.decorator_list):
+            out.line("local function " + node.name + "(" + ", ".join([arg.arg for arg in node.args.args]) + ")")
+        elif "anon" in (dec.id for dec in node.decorator_list):
+            out.line("function(" + ", ".join([arg.arg for arg in node.args.args]) + ")")
+        else:
+            out.line("function " + node.name + "(" + ", ".join([arg.arg for arg in node.args.args]) + ")")
+        if "local" in (dec.id for dec in node.decorator_list):
+            self.define(node.name)
+        with out.indented(), self.scope([arg.arg for arg in node.args.args], string_arguments(node), node), \
+                self.function_body(node, out):
+            self.emit_body(node.body, out)
+        out.line("end")
+
+    @contextmanager
+    def closure_body(self):
+        """Stops instrumented returns from counting an exit of the enclosing function inside a closure"""
+        self.profile_ids.append(None)
+        try:
+            yield
+        finally:
+            self.profile_ids.pop()
+
+    def _emit_try(self, node: ast.Try, out: Emitter):
+        if len(node.handlers) == 1 and len(node.handlers[0].body) == 1 and isinstance(node.handlers[0].body[0], ast.Pass):
+            out.line("pcall(function()")
+            with out.indented(), self.closure_body():
+                self.emit_body(node.body, out)
+            out.line("end)")
+        else:
+            out.line("xpcall(function()")
+            with out.indented(), self.closure_body():
+                self.emit_body(node.body, out)
+            out.line("end, function(err)")
+            with self.closure_body():
+                self.emit_body(node.handlers, out)
+            out.line("end)")
+
+    def _emit_break(self, node: ast.Break, out: Emitter):
+        out.line("break")
+
+    def _emit_raise(self, node: ast.Raise, out: Emitter):
+        out.line("error(" + self.unparse_expr(node.exc) + ")")
+
+    def _emit_except_handler(self, node: ast.ExceptHandler, out: Emitter):
+        with out.indented():
+            self.emit_body(node.body, out)
+
+    def _emit_import(self, node: ast.Import, out: Emitter):
+        for names in node.names:
+            name = import_name(names)
+            if name != names.name and names.asname is None:
+                # import a.b binds a, which holds b once it is loaded
+                out.line(self.generate_require(names.name))
+                out.line(f"local {name} = " + self.generate_require(name))
+            else:
+                out.line(f"local {name} = " + self.generate_require(names.name))
+            self.define(name)
+
+    def _emit_import_from(self, node: ast.ImportFrom, out: Emitter):
+        for names in node.names:
+            name = names.name
+            if name == "*":
+                out.line(f"for k, v in next, {self.generate_require(node.module)} do")
+                out.line("    getfenv()[k] = v")
+                out.line("end")
+            elif f"{node.module}.{name}" in self.bundled_modules:
+                # a submodule of the package, loaded like import does
+                out.line(f"local {names.asname or name} = " + self.generate_require(f"{node.module}.{name}"))
+                self.define(names.asname or name)
+            else:
+                out.line(f"local {names.asname or name} = " + f"{self.generate_require(node.module)}.{names.name}")
+                self.define(names.asname or name)
+
+    def _emit_async_function_def(self, node: ast.AsyncFunctionDef, out: Emitter):
+        out.line(f"local {node.name} = coroutine.create(function({', '.join([arg.arg for arg in node.args.args])})")
+        self.define(node.name)
+        with out.indented(), self.scope([arg.arg for arg in node.args.args], string_arguments(node), node), \
+                self.function_body(node, out):
+            self.emit_body(node.body, out)
+        out.line("end)")
+
+    def _emit_await(self, node: ast.Await, out: Emitter):
+        out.line(f"coroutine.resume({self.unparse_expr(node.value)})")
+
+    def _emit_lambda(self, node: ast.Lambda, out: Emitter):
+        out.line("function " + self.unparse_expr(node.args))
+        with out.indented():
+            self.emit_body(node.body, out)
+        out.line("end")
+
+    def _emit_ann_assign(self, node: ast.AnnAssign, out: Emitter):
+        if node.annotation.id == "local":
+            out.line(f"local {self.unparse_expr(node.target)} = " + self.unparse_expr(node.value))
+            self.define(node.target.id)
+            self.set_string(node.target.id, self.is_string(node.value))
+
+    def _emit_aug_assign(self, node: ast.AugAssign, out: Emitter):
+        if isinstance(node.target, ast.Name) and node.target.id in self.buffers:
+            buffer = self.buffers[node.target.id]
+            out.line(f"{buffer}[#{buffer} + 1] = " + self.unparse_expr(node.value))
+            return
+        if isinstance(node.op, ast.Add) and (self.is_string(node.target) or self.is_string(node.value)):
+            operator = ".."
+            if isinstance(node.target, ast.Name):
+                self.set_string(node.target.id, True)
+        else:
+            operator = self.unparse_expr(node.op)
+        out.line(self.unparse_expr(node.target) + " = " +
+                 self.unparse_expr(node.target) + " " +
+                 operator + " " +
+                 self.unparse_expr(node.value))
+
+    stmt_handlers = {
+        ast.Assign: _emit_assign,
+        ast.For: _emit_for,
+        ast.Expr: _emit_expr,
+        ast.If: _emit_if,
+        ast.While: _emit_while,
+        ast.Pass: _emit_pass,
+        ast.Return: _emit_return,
+        ast.FunctionDef: _emit_function_def,
+        ast.Try: _emit_try,
+        ast.Break: _emit_break,
+        ast.Raise: _emit_raise,
+        ast.ExceptHandler: _emit_except_handler,
+        ast.Import: _emit_import,
+        ast.ImportFrom: _emit_import_from,
+        ast.AsyncFunctionDef: _emit_async_function_def,
+        ast.Await: _emit_await,
+        ast.Lambda: _emit_lambda,
+        ast.AnnAssign: _emit_ann_assign,
+        ast.AugAssign: _emit_aug_assign,
+        ast.Global: _emit_global,
+        ast.Nonlocal: _emit_global,
+    }
+
+
+BASE64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+
+
+def encode_vlq(value: int):
+    """Encodes an integer as a base64 VLQ, as used by source maps"""
+    value = (-value << 1) | 1 if value < 0 else value << 1
+    encoded = ""
+    while True:
+        digit = value & 31
+        value >>= 5
+        if value:
+            digit |= 32
+        encoded += BASE64[digit]
+        if not value:
+            return encoded
+
+
+def decode_vlq(segment: str):
+    """Decodes every base64 VLQ integer of a source map segment"""
+    values = []
+    value = shift = 0
+    for char in segment:
+        digit = BASE64.index(char)
+        value += (digit & 31) << shift
+        if digit & 32:
+            shift += 5
+        else:
+            values.append(-(value >> 1) if value & 1 else value >> 1)
+            value = shift = 0
+    return values
+
+
+class SourceMap:
+    """
+    Maps the lines of generated lua to the python statements they came from.
+    Stored in the source map v3 format, with one segment at the start of every
+    lua line a statement begins on. Lua lines are 1-based, python lines are
+    1-based and columns 0-based, like in the ast.
+    """
+
+    def __init__(self, sources: List[str] = None, *, file: str = None):
+        self.file = file
+        self.sources = list(sources or [""])
+        # index of the source being transpiled
+        self.source = 0
+        # (lua line, source, python line, python column), sorted by lua line
+        self.mappings = []
+
+    def use(self, source: str):
+        """Makes ``source`` the source of the following mappings"""
+        if source not in self.sources:
+            self.sources.append(source)
+        self.source = self.sources.index(source)
+
+    def add(self, lua_line: int, node: ast.AST):
+        mapping = (lua_line, self.source, node.lineno, node.col_offset)
+        # a statement that emitted nothing shares its line with the next one
+        if self.mappings and self.mappings[-1][0] == lua_line:
+            self.mappings[-1] = mapping
+        else:
+            self.mappings.append(mapping)
+
+    def remap(self, lines: List[int]):
+        """Moves every mapping from lua line ``n`` to ``lines[n]``, after lines were merged or dropped"""
+        mappings = []
+        for lua_line, source, line, column in self.mappings:
+            lua_line = lines[min(lua_line, len(lines) - 1)]
+            # merged lines keep the first statement on them
+            if not mappings or mappings[-1][0] != lua_line:
+                mappings.append((lua_line, source, line, column))
+        self.mappings = mappings
+
+    def lookup(self, lua_line: int):
+        """Returns ``(source, python line, python column)`` of the statement ``lua_line`` belongs to, or None"""
+        index = bisect.bisect_right(self.mappings, (lua_line, math.inf)) - 1
+        if index < 0:
+            return None
+        _, source, line, column = self.mappings[index]
+        return self.sources[source], line, column
+
+    def translate(self, text: str):
+        """Appends the python location to every ``:line:`` of a lua error or traceback"""
+        def replace(match):
+            location = self.lookup(int(match.group(1)))
+            if location is None:
+                return match.group(0)
+            return f":{match.group(1)} ({location[0]}:{location[1]}):"
+        return re.sub(r":(\d+):", replace, text)
+
+    def encode(self):
+        """Returns the VLQ encoded mappings field"""
+        lines = []
+        previous_source = previous_line = previous_column = 0
+        for lua_line, source, line, column in self.mappings:
+            lines.extend([""] * (lua_line - 1 - len(lines)))
+            lines.append("A" + encode_vlq(source - previous_source) + encode_vlq(line - 1 - previous_line) +
+                         encode_vlq(column - previous_column))
+            previous_source, previous_line, previous_column = source, line - 1, column
+        return ";".join(lines)
+
+    def to_json(self):
+        return {"version": 3, "file": self.file or "", "sources": self.sources, "names": [], "mappings": self.encode()}
+
+    @classmethod
+    def from_json(cls, data: dict):
+        source_map = cls(data["sources"], file=data.get("file"))
+        source = line = column = 0
+        for lua_line, segments in enumerate(data["mappings"].split(";"), 1):
+            for segment in filter(None, segments.split(",")):
+                values = decode_vlq(segment)
+                if len(values) < 4:
+                    continue
+                source += values[1]
+                line += values[2]
+                column += values[3]
+                source_map.mappings.append((lua_line, source, line + 1, column))
+        return source_map
+
+    def save(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            return cls.from_json(json.load(f))
+
+
+class Profiler:
+    """
+    Records how often each node type is handled and how long it takes,
+    the deepest nesting of handlers reached and the number of utf-8 bytes
+    emitted by every top level function. Pass one to a Transpiler.
+    """
+
+    def __init__(self):
+        # node type name -> [count, cumulative seconds, self seconds]
+        self.nodes = {}
+        self.functions = {}
+        self.depth = 0
+        self.max_depth = 0
+        self.body_depth = 0
+        self._active = {}
+        self._children = []
+        self._started = []
+
+    def call(self, node: ast.AST, handler, *args):
+        """Calls ``handler(*args)``, recording it as handling ``node``"""
+        self.enter(node)
+        try:
+            return handler(*args)
+        finally:
+            self.exit()
+
+    def enter(self, node: ast.AST):
+        """Starts timing ``node``, nodes entered before its exit are its children"""
+        name = type(node).__name__
+        self.depth += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self._active[name] = self._active.get(name, 0) + 1
+        self._children.append(0.0)
+        self._started.append((name, time.perf_counter()))
+
+    def exit(self):
+        """Stops timing the node entered last"""
+        name, start = self._started.pop()
+        elapsed = time.perf_counter() - start
+        children = self._children.pop()
+        if self._children:
+            self._children[-1] += elapsed
+        self.depth -= 1
+        self._active[name] -= 1
+        stats = self.nodes.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        # nested nodes of the same type are already part of the outermost one
+        if not self._active[name]:
+            stats[1] += elapsed
+        stats[2] += elapsed - children
+
+    def to_json(self):
+        return {
+            "nodes": {name: {"count": count, "cumulative_s": cumulative, "self_s": own}
+                      for name, (count, cumulative, own) in self.nodes.items()},
+            "max_depth": self.max_depth,
+            "functions": dict(self.functions),
+        }
+
+    def report(self):
+        """Returns a table of the node types sorted by cumulative time"""
+        lines = [f"{'node':<20} {'count':>8} {'cumulative ms':>14} {'self ms':>10}"]
+        for name, (count, cumulative, own) in sorted(self.nodes.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<20} {count:>8} {cumulative*1000:>14.3f} {own*1000:>10.3f}")
+        lines.append(f"max nesting depth: {self.max_depth}")
+        if self.functions:
+            lines.append("emitted per top level function:")
+            for name, size in sorted(self.functions.items(), key=lambda item: -item[1]):
+                lines.append(f"    {name:<30} {size:>10} bytes")
+        return "\n".join(lines)
+
+
+def string_arguments(node: ast.FunctionDef):
+    """Returns the arguments of a function annotated as ``str``"""
+    return [arg.arg for arg in node.args.args if isinstance(arg.annotation, ast.Name) and arg.annotation.id == "str"]
+
+
+def import_name(alias: ast.alias):
+    """Returns the name an imported alias binds, ``import a.b`` binds ``a``"""
+    return alias.asname or alias.name.split(".")[0]
+
+
+def decorator_names(node: ast.FunctionDef):
+    return [dec.id for dec in node.decorator_list if isinstance(dec, ast.Name)]
+
+
+def is_docstring(node: ast.AST):
+    return isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+
+
+def is_main_guard(node: ast.AST):
+    """Checks for ``if __name__ == "__main__":``"""
+    return isinstance(node, ast.If) and isinstance(node.test, ast.Compare) and \
+        isinstance(node.test.left, ast.Name) and node.test.left.id == "__name__"
+
+
+def module_exports(body: List[ast.AST]):
+    """Returns the names bound by the top level statements of a module, in order"""
+    exports = []
+    for node in body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            names = [node.name]
+        elif isinstance(node, ast.Assign):
+            names = [target.id for target in node.targets if isinstance(target, ast.Name)]
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            names = [node.target.id]
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names = [import_name(alias) for alias in node.names if alias.name != "*"]
+        else:
+            continue
+        exports.extend(name for name in names if name not in exports)
+    return exports
+
+
+def is_pure(node: ast.AST):
+    """Checks if evaluating an expression has no side effects"""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, (ast.Constant, ast.Name, ast.Lambda)):
+            continue
+        elif isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+            stack.extend(node.elts)
+        elif isinstance(node, ast.Dict) and None not in node.keys:
+            stack.extend(node.keys)
+            stack.extend(node.values)
+        else:
+            return False
+    return True
+
+
+def loaded_names(node: ast.AST):
+    """
+    Yields ``(name, attribute)`` for every name ``node`` reads. ``attribute``
+    is set when the name is only used to read that attribute, else None.
+    """
+    attribute_bases = set()
+    for child in ast.walk(node):
+        if isinstance(child, ast.Attribute) and isinstance(child.value, ast.Name) and isinstance(child.value.ctx, ast.Load):
+            attribute_bases.add(id(child.value))
+            yield child.value.id, child.attr
+        elif isinstance(child, ast.Name) and isinstance(child.ctx, ast.Load) and id(child) not in attribute_bases:
+            yield child.id, None
+        elif isinstance(child, ast.AugAssign) and isinstance(child.target, ast.Name):
+            # x += 1 reads x as well
+            yield child.target.id, None
+
+
+class TreeShaker:
+    """
+    Finds the statements reachable from the body of main, following the
+    names they read into the top level of bundled modules. Function
+    definitions, imports and assignments of side effect free values that
+    are never reached are dropped, every other statement of a used module
+    is kept.
+    """
+
+    def __init__(self, root: ast.FunctionDef, modules: dict):
+        self.modules = modules
+        self.scopes = {None: root.body, **{name: tree.body for name, tree in modules.items()}}
+        self.bindings = {scope: self._find_bindings(body) for scope, body in self.scopes.items()}
+        self.star_imports = {
+            scope: [node.module for node in body if isinstance(node, ast.ImportFrom) and
+                    node.module in modules and any(alias.name == "*" for alias in node.names)]
+            for scope, body in self.scopes.items()
+        }
+        self.kept = set()
+        self.kept_aliases = set()
+        self.included = set()
+        self.needed = set()
+        # (scope, name, attribute) needed but not followed yet, and modules to include
+        self.pending = []
+        self.pending_modules = []
+
+    @staticmethod
+    def _find_bindings(body: List[ast.AST]):
+        """Maps the names bound by the removable statements of ``body`` to ``(statement, alias)``"""
+        bindings = {}
+        for node in body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and "anon" not in decorator_names(node):
+                found = [(node.name, None)]
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                found = [(import_name(alias), alias) for alias in node.names if alias.name != "*"]
+            elif isinstance(node, ast.Assign) and all(isinstance(target, ast.Name) for target in node.targets) and is_pure(node.value):
+                found = [(target.id, None) for target in node.targets]
+            elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name) and node.value is not None and is_pure(node.value):
+                found = [(node.target.id, None)]
+            else:
+                continue
+            for name, alias in found:
+                bindings.setdefault(name, []).append((node, alias))
+        return bindings
+
+    def shake(self):
+        """Returns the reachable body of main and the used modules, with their reachable bodies"""
+        self.include(None)
+        # a worklist instead of recursion, long call chains would exhaust the recursion limit
+        while self.pending or self.pending_modules:
+            if self.pending_modules:
+                self.include(self.pending_modules.pop())
+            else:
+                self.resolve(*self.pending.pop())
+        modules = {}
+        for name, tree in self.modules.items():
+            if name in self.included:
+                modules[name] = ast.Module(body=self._filter(tree.body), type_ignores=[])
+        return self._filter(self.scopes[None]), modules
+
+    def _filter(self, body: List[ast.AST]):
+        kept = []
+        for node in body:
+            if isinstance(node, (ast.Import, ast.ImportFrom)) and not any(alias.name == "*" for alias in node.names):
+                aliases = [alias for alias in node.names if id(alias) in self.kept_aliases]
+                if aliases:
+                    node.names = aliases
+                    kept.append(node)
+            elif id(node) in self.kept:
+                kept.append(node)
+        return kept
+
+    def include(self, scope):
+        """Marks a module as used, keeping every statement of it that cannot be removed"""
+        if scope in self.included:
+            return
+        self.included.add(scope)
+        removable = {id(bound) for bindings in self.bindings[scope].values() for bound, _ in bindings}
+        for node in self.scopes[scope]:
+            if id(node) not in removable:
+                self.keep(scope, node)
+
+    def keep(self, scope, node: ast.AST):
+        if id(node) in self.kept:
+            return
+        self.kept.add(id(node))
+        if isinstance(node, ast.ImportFrom) and node.module in self.modules:
+            self.pending_modules.append(node.module)
+        for name, attribute in loaded_names(node):
+            self.need(scope, name, attribute)
+
+    def need(self, scope, name: str, attribute: str = None):
+        """Queues ``name`` of ``scope`` to be kept, ``attribute`` is the only part of it used if set"""
+        if (scope, name, attribute) not in self.needed:
+            self.needed.add((scope, name, attribute))
+            self.pending.append((scope, name, attribute))
+
+    def resolve(self, scope, name: str, attribute: str = None):
+        """Keeps whatever binds a needed ``name`` in ``scope``"""
+        bindings = self.bindings[scope].get(name)
+        if not bindings:
+            for module in self.star_imports[scope]:
+                if name in self.bindings[module]:
+                    self.need(module, name)
+            return
+
+        for node, alias in bindings:
+            if alias is None:
+                self.keep(scope, node)
+                continue
+            self.kept_aliases.add(id(alias))
+            if isinstance(node, ast.Import):
+                # importing a submodule runs its packages too
+                for module in module_prefixes(alias.name):
+                    if module in self.modules:
+                        self.include(module)
+                bound = alias.name if alias.asname else name
+                if bound in self.modules:
+                    self.need_module(bound, attribute)
+                if bound != alias.name and alias.name in self.modules:
+                    # only reached through attributes of its package
+                    self.need_module(alias.name)
+            elif isinstance(node, ast.ImportFrom):
+                if node.module in self.modules:
+                    self.include(node.module)
+                    self.need(node.module, alias.name)
+                submodule = f"{node.module}.{alias.name}"
+                if submodule in self.modules:
+                    self.include(submodule)
+                    self.need_module(submodule, attribute)
+
+    def need_module(self, module: str, attribute: str = None):
+        """Queues ``attribute`` of a bundled module, or all of its names if it is not set"""
+        if attribute is not None:
+            self.need(module, attribute)
+        else:
+            for export in self.bindings[module]:
+                self.need(module, export)
+
+
+def lua_truthy(value):
+    """Returns the truthiness of a constant in lua, where only nil and false are false"""
+    return value is not None and value is not False
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class ConstantFolder(ast.NodeTransformer):
+    """
+    Folds constant expressions, replaces names listed in ``constants`` by
+    their value and drops if and while branches whose test is statically
+    false. Truthiness follows lua, so the generated code behaves the same
+    as without folding.
+    """
+
+    def __init__(self, constants: dict = None):
+        self.constants = constants if constants is not None else {}
+
+    def visit(self, node: ast.AST):
+        """
+        Folds ``node`` bottom up. Unlike NodeTransformer this walks the tree
+        with an explicit stack, so the visit_* methods see their children
+        already folded and deep expressions cannot exhaust the recursion limit.
+        """
+        folded = {}
+        stack = [(node, False)]
+        while stack:
+            current, children_done = stack.pop()
+            if not children_done:
+                stack.append((current, True))
+                stack.extend((child, False) for child in ast.iter_child_nodes(current))
+                continue
+            for field, old_value in ast.iter_fields(current):
+                if isinstance(old_value, list):
+                    new_values = []
+                    for value in old_value:
+                        if isinstance(value, ast.AST):
+                            value = folded[id(value)]
+                            if value is None:
+                                continue
+                            elif not isinstance(value, ast.AST):
+                                new_values.extend(value)
+                                continue
+                        new_values.append(value)
+                    old_value[:] = new_values
+                elif isinstance(old_value, ast.AST):
+                    new_node = folded[id(old_value)]
+                    if new_node is None:
+                        delattr(current, field)
+                    else:
+                        setattr(current, field, new_node)
+            visitor = getattr(self, "visit_" + current.__class__.__name__, None)
+            folded[id(current)] = visitor(current) if visitor is not None else current
+        return folded[id(node)]
+
+    def visit_Name(self, node: ast.Name):
+        if isinstance(node.ctx, ast.Load) and node.id in self.constants:
+            return ast.copy_location(ast.Constant(self.constants[node.id]), node)
+        return node
+
+    def visit_BinOp(self, node: ast.BinOp):
+        if not (isinstance(node.left, ast.Constant) and isinstance(node.right, ast.Constant)):
+            return node
+        left, right = node.left.value, node.right.value
+        if is_number(left) and is_number(right) and type(node.op) in FOLDABLE_OPERATORS:
+            try:
+                value = FOLDABLE_OPERATORS[type(node.op)](left, right)
+            except ArithmeticError:
+                return node
+            # inf and nan have no literal in lua
+            if isinstance(value, float) and not math.isfinite(value):
+                return node
+        elif isinstance(left, str) and isinstance(right, str) and isinstance(node.op, ast.Add):
+            value = left + right
+        else:
+            return node
+        return ast.copy_location(ast.Constant(value), node)
+
+    def visit_UnaryOp(self, node: ast.UnaryOp):
+        if not isinstance(node.operand, ast.Constant):
+            return node
+        value = node.operand.value
+        if isinstance(node.op, ast.Not):
+            return ast.copy_location(ast.Constant(not lua_truthy(value)), node)
+        elif isinstance(node.op, ast.USub) and is_number(value):
+            return ast.copy_location(ast.Constant(-value), node)
+        elif isinstance(node.op, ast.UAdd) and is_number(value):
+            return node.operand
+        return node
+
+    def visit_BoolOp(self, node: ast.BoolOp):
+        values = node.values
+        # a and b is a when a is false, else b. a or b is a when a is true, else b
+        while len(values) > 1 and isinstance(values[0], ast.Constant):
+            if lua_truthy(values[0].value) == isinstance(node.op, ast.Or):
+                return values[0]
+            values = values[1:]
+        # a single value keeps its parentheses unless it is a constant
+        if len(values) == 1 and isinstance(values[0], ast.Constant):
+            return values[0]
+        node.values = values
+        return node
+
+    def visit_Compare(self, node: ast.Compare):
+        if len(node.ops) != 1 or type(node.ops[0]) not in FOLDABLE_COMPARISONS:
+            return node
+        if not (isinstance(node.left, ast.Constant) and isinstance(node.comparators[0], ast.Constant)):
+            return node
+        left, right = node.left.value, node.comparators[0].value
+        if isinstance(node.ops[0], (ast.Eq, ast.NotEq, ast.Is, ast.IsNot)):
+            # lua never considers values of different types equal
+            comparable = type(left) is type(right) or (is_number(left) and is_number(right))
+        else:
+            comparable = (is_number(left) and is_number(right)) or (isinstance(left, str) and isinstance(right, str))
+        if not comparable:
+            return node
+        value = FOLDABLE_COMPARISONS[type(node.ops[0])](left, right)
+        return ast.copy_location(ast.Constant(value), node)
+
+    def visit_If(self, node: ast.If):
+        if isinstance(node.test, ast.Constant):
+            if not lua_truthy(node.test.value):
+                return node.orelse
+            node.orelse = []
+        return node
+
+    def visit_While(self, node: ast.While):
+        if isinstance(node.test, ast.Constant) and not lua_truthy(node.test.value):
+            return node.orelse
+        return node
+
+
+def find_module_constants(tree: ast.Module):
+    """
+    Returns the module level names that are assigned a constant exactly once
+    and never bound anywhere else, mapped to their folded value
+    """
+    bindings = {}
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            names = [node.id]
+        elif isinstance(node, ast.arg):
+            names = [node.arg]
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names = [node.name]
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names = [import_name(alias) for alias in node.names]
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            names = node.names
+        elif isinstance(node, ast.ExceptHandler) and node.name:
+            names = [node.name]
+        else:
+            continue
+        for name in names:
+            bindings[name] = bindings.get(name, 0) + 1
+
+    constants = {}
+    folder = ConstantFolder(constants)
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            name = node.targets[0].id
+            value = folder.visit(node.value)
+            if bindings[name] == 1 and isinstance(value, ast.Constant) and isinstance(value.value, CONSTANT_TYPES):
+                constants[name] = value.value
+    return constants
+
+
+def fold_constants(tree: ast.Module) -> ast.Module:
+    """Propagates module level constants through ``tree`` and folds it"""
+    return ConstantFolder(find_module_constants(tree)).visit(tree)
+
+
+class Minifier:
+    """
+    Shrinks generated lua. Whitespace and comments are stripped, locals,
+    parameters and loop variables get the shortest names free in their
+    scope, consecutive single line ``local`` statements are merged and, with
+    ``pool_strings``, string literals repeated often enough to pay off are
+    declared once as locals at the top of the chunk. Globals and table
+    fields keep their names.
+    Line breaks are kept since lua reads a line starting with ``(`` as a new
+    statement, ``lines[n]`` is the output line input line ``n`` ended up on.
+    """
+
+    def __init__(self, lua: str, *, pool_strings=False):
+        self.tokens = tokenize_lua(lua)
+        self.pool_strings = pool_strings
+        self.lines = []
+
+    def minify(self) -> str:
+        if self.pool_strings:
+            self.pool()
+        self.rename()
+        return self.emit()
+
+    def pool(self):
+        """Replaces repeated string literals by locals declared on a line of their own before the chunk"""
+        tokens = self.tokens
+        occurrences = {}
+        for index, (kind, text, _) in enumerate(tokens):
+            if kind != "string":
+                continue
+            previous = tokens[index - 1] if index else None
+            # f"text" calls f, f name would not
+            if previous is not None and (previous[1] in (")", "]", "}") or previous[0] == "string" or
+                                         (previous[0] == "name" and previous[1] not in LUA_KEYWORDS)):
+                continue
+            occurrences.setdefault(text, []).append(index)
+        # every use still costs a name of about two characters, plus the declaration once
+        savings = {text: (len(text) - 2)*len(indices) - len(text) - 4 for text, indices in occurrences.items()}
+        pooled = sorted((text for text in savings if savings[text] > 0), key=savings.get, reverse=True)
+        pooled = pooled[:POOLED_STRINGS_LIMIT]
+        if not pooled:
+            return
+        used = {text for kind, text, _ in tokens if kind == "name"}
+        names = []
+        for text in pooled:
+            name = f"__string_{len(names)}"
+            while name in used:
+                name += "_"
+            names.append(name)
+            for index in occurrences[text]:
+                tokens[index] = ("name", name, tokens[index][2])
+        # line 0 comes before the first line of the chunk
+        declaration = [("name", "local", 0)]
+        for name in names:
+            declaration += [("name", name, 0), ("symbol", ",", 0)]
+        declaration[-1] = ("symbol", "=", 0)
+        for text in pooled:
+            declaration += [("string", text, 0), ("symbol", ",", 0)]
+        self.tokens = declaration[:-1] + tokens
+
+    def rename(self):
+        """
+        Resolves every name to the local it refers to and renames the locals.
+        A local is named after its slot, the number of locals visible where it
+        is declared, so it never shadows a local still in use while locals of
+        sibling scopes share names.
+        """
+        tokens = self.tokens
+        slots = []
+        # names of the visible locals, their bindings by name and where every scope starts in them
+        visible = []
+        bindings = {}
+        scopes = []
+        # (token index, binding) of every declaration and use of a local
+        uses = []
+        declarations = set()
+        free = {"self"}
+        # locals of a local statement become visible once it ends, loop variables inside the loop
+        pending = []
+        loops = []
+        untils = []
+        brackets = []
+        header = None
+        implicit = set()
+
+        def declare(index):
+            binding = len(slots)
+            slots.append(None)
+            if index is not None:
+                uses.append((index, binding))
+                declarations.add(index)
+            return binding
+
+        def declare_names(index):
+            """Declares the comma separated names starting at ``index``"""
+            names = []
+            while tokens[index][0] == "name" and tokens[index][1] not in LUA_KEYWORDS:
+                names.append((tokens[index][1], declare(index)))
+                if index + 1 >= len(tokens) or tokens[index + 1][1] != ",":
+                    break
+                index += 2
+            return names
+
+        def activate(name, binding):
+            slots[binding] = len(visible)
+            visible.append(name)
+            bindings.setdefault(name, []).append(binding)
+
+        def open_scope(names=()):
+            scopes.append(len(visible))
+            for name, binding in names:
+                activate(name, binding)
+
+        def close_scope():
+            end_statement()
+            start = scopes.pop() if scopes else 0
+            while len(visible) > start:
+                bindings[visible.pop()].pop()
+
+        def end_statement():
+            while pending and pending[-1][1] == len(scopes) and pending[-1][2] == len(brackets):
+                for name, binding in pending.pop()[0]:
+                    activate(name, binding)
+
+        previous_line = None
+        for index, (kind, text, line) in enumerate(tokens):
+            if line != previous_line:
+                end_statement()
+                while untils and untils[-1] == len(scopes):
+                    untils.pop()
+                    close_scope()
+                previous_line = line
+            previous = tokens[index - 1][1] if index else None
+            if kind == "symbol":
+                if text == ";":
+                    end_statement()
+                elif text in ("(", "[", "{"):
+                    if text == "(" and header is not None:
+                        # the parameters are locals of the function body
+                        params = []
+                        position = index + 1
+                        while tokens[position][1] != ")":
+                            if tokens[position][0] == "name":
+                                params.append((tokens[position][1], declare(position)))
+                            position += 1
+                        if header == ":":
+                            method_self = declare(None)
+                            implicit.add(method_self)
+                            params.insert(0, ("self", method_self))
+                        open_scope(params)
+                        header = None
+                    brackets.append(text)
+                elif text in (")", "]", "}"):
+                    if brackets:
+                        brackets.pop()
+                elif text == ":" and header is not None:
+                    header = ":"
+                continue
+            if kind != "name" or index in declarations:
+                continue
+            if text in LUA_KEYWORDS:
+                if text == "function":
+                    header = "function"
+                    if previous == "local":
+                        # visible in its own body, so it can call itself
+                        activate(tokens[index + 1][1], declare(index + 1))
+                elif text == "local" and tokens[index + 1][1] != "function":
+                    pending.append((declare_names(index + 1), len(scopes), len(brackets)))
+                elif text == "for":
+                    loops.append((declare_names(index + 1), len(scopes)))
+                elif text == "do":
+                    open_scope(loops.pop()[0] if loops and loops[-1][1] == len(scopes) else ())
+                elif text in ("then", "repeat"):
+                    open_scope()
+                elif text == "elseif":
+                    close_scope()
+                elif text == "else":
+                    close_scope()
+                    open_scope()
+                elif text == "end":
+                    close_scope()
+                elif text == "until":
+                    # the condition still sees the locals of the loop body
+                    end_statement()
+                    untils.append(len(scopes))
+                continue
+            if previous in (".", ":"):
+                continue
+            if brackets and brackets[-1] == "{" and previous in ("{", ",", ";") and tokens[index + 1][1] == "=":
+                # the key of a table constructor field
+                continue
+            if bindings.get(text):
+                uses.append((index, bindings[text][-1]))
+            else:
+                free.add(text)
+        end_statement()
+        for names, _, _ in pending:
+            for name, binding in names:
+                activate(name, binding)
+
+        names = short_names(max((slot for slot in slots if slot is not None), default=-1) + 1, free)
+        for index, binding in uses:
+            kind, _, line = tokens[index]
+            # self is declared implicitly by methods, it keeps its name
+            tokens[index] = (kind, "self" if binding in implicit else names[slots[binding]], line)
+
+    def emit(self) -> str:
+        """Joins the tokens of every line with as few spaces as possible, merging local statements"""
+        output = []
+        lines = {}
+        group = None
+        start = 0
+        tokens = self.tokens
+        while start < len(tokens):
+            end = start
+            line = tokens[start][2]
+            while end < len(tokens) and tokens[end][2] == line:
+                end += 1
+            statement = tokens[start:end]
+            start = end
+            declaration = parse_local(statement)
+            if declaration is not None and group is not None and can_merge(group, *declaration):
+                group[0].extend(declaration[0])
+                if group[1] is not None:
+                    group[1].extend(declaration[1])
+            elif declaration is not None:
+                group = (list(declaration[0]), None if declaration[1] is None else list(declaration[1]))
+                output.append(group)
+            else:
+                group = None
+                output.append(join_lua(statement))
+            lines[line] = len(output)
+
+        # lines without code belong to the next line with code
+        last = max(lines, default=0)
+        self.lines = [0] * (last + 1)
+        following = len(output)
+        for line in range(last, -1, -1):
+            following = lines.get(line, following)
+            self.lines[line] = following
+        return "".join((line if isinstance(line, str) else join_local(*line)) + "\n" for line in output)
+
+
+def tokenize_lua(lua: str):
+    """Splits ``lua`` into ``(kind, text, line)`` tokens, leaving out whitespace and comments"""
+    tokens = []
+    line = 1
+    for match in LUA_TOKEN.finditer(lua):
+        kind, text = match.lastgroup, match.group()
+        if kind == "newline":
+            line += 1
+            continue
+        if kind not in ("space", "comment"):
+            tokens.append((kind, text, line))
+        line += text.count("\n")
+    return tokens
+
+
+def short_names(count: int, reserved: set):
+    """Returns the ``count`` shortest lua names that are not keywords or ``reserved``"""
+    names = []
+    length = 1
+    while len(names) < count:
+        for first in itertools.product(NAME_START, *[NAME_CHARS]*(length - 1)):
+            name = "".join(first)
+            if name not in LUA_KEYWORDS and name not in reserved and name != "goto":
+                names.append(name)
+                if len(names) == count:
+                    break
+        length += 1
+    return names
+
+
+def join_lua(tokens: list):
+    """Joins tokens, with a space only where they would otherwise read as different tokens"""
+    parts = []
+    previous = None
+    for token in tokens:
+        text = token[1]
+        if previous is not None:
+            last, first = previous[1][-1], text[0]
+            if ((last.isalnum() or last == "_") and (first.isalnum() or first == "_") or
+                    previous[0] == "number" and first == "." or
+                    last + first in ("..", "--", "[[", "[=", "==", "<=", ">=", "~=")):
+                parts.append(" ")
+        parts.append(text)
+        previous = token
+    return "".join(parts)
+
+
+def parse_local(tokens: list):
+    """
+    Returns the names and the value of every name of a single line local
+    statement, values is None for a declaration without values. Returns None
+    for anything else, including declarations taking several values from one call.
+    """
+    if len(tokens) < 2 or tokens[0][1] != "local" or tokens[1][1] == "function":
+        return None
+    names = []
+    index = 1
+    while True:
+        if tokens[index][0] != "name":
+            return None
+        names.append(tokens[index][1])
+        index += 1
+        if index == len(tokens):
+            return names, None
+        elif tokens[index][1] == "=":
+            break
+        elif tokens[index][1] != ",":
+            return None
+        index += 1
+    values = [[]]
+    depth = 0
+    for token in tokens[index + 1:]:
+        if token[0] == "name" and token[1] in ("function", "end", "do", "then"):
+            return None
+        elif token[0] == "symbol" and token[1] in ("(", "[", "{"):
+            depth += 1
+        elif token[0] == "symbol" and token[1] in (")", "]", "}"):
+            depth -= 1
+        elif token[1] == "," and depth == 0:
+            values.append([])
+            continue
+        values[-1].append(token)
+    if depth != 0 or len(values) != len(names) or not all(values):
+        return None
+    return names, values
+
+
+def can_merge(group: tuple, names: list, values: list):
+    """Checks if a local statement can join the ``(names, values)`` of the ones before it"""
+    group_names, group_values = group
+    if (group_values is None) != (values is None) or len(group_names) + len(names) > MERGED_LOCALS_LIMIT:
+        return False
+    declared = set(group_names)
+    if declared.intersection(names):
+        return False
+    # the values of a merged statement cannot see the locals it declares
+    return values is None or not any(token[0] == "name" and token[1] in declared for value in values for token in value)
+
+
+def join_local(names: list, values: list):
+    if values is None:
+        return "local " + ",".join(names)
+    return "local " + ",".join(names) + "=" + ",".join(join_lua(value) for value in values)
+
+
+def minify(lua: str, *, pool_strings=False, source_map: "SourceMap" = None) -> str:
+    """Minifies generated ``lua``, moving the lines of ``source_map`` along"""
+    minifier = Minifier(lua, pool_strings=pool_strings)
+    minified = minifier.minify()
+    if source_map is not None:
+        source_map.remap(minifier.lines)
+    return minified
+
+
+# module level api, kept for backwards compatibility. It shares one
+# Transpiler, so definitions persist between calls like they always did.
+_transpiler = Transpiler()
+generate_attribute = _transpiler.generate_attribute
+generate_multiple = _transpiler.generate_multiple
+generate_for_loop = _transpiler.generate_for_loop
+handle_assign = _transpiler.handle_assign
+handle_list_comp = _transpiler.handle_list_comp
+unparse_expr = _transpiler.unparse_expr
+handle_test = _transpiler.handle_test
+handle_body = _transpiler.handle_body
+emit_body = _transpiler.emit_body
+
+
+# node types NameAnalysis looks at, matched exactly
+FUNCTION_NODES = {ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda}
+SCOPE_NODES = {ast.For, ast.While, *FUNCTION_NODES}
+EXIT_NODES = {ast.Return, ast.Yield, ast.YieldFrom}
+# fields of every node type that can hold child nodes, without the operators and contexts
+CHILD_FIELDS = {}
+
+
+class NameAnalysis:
+    """
+    Facts about how the statements of a chunk use names, gathered in a single
+    pass so emitting a loop or a function does not walk its code again.
+    Nodes are numbered in pre-order, which makes the nodes inside a loop or
+    a function a range of numbers, and every question a binary search over
+    the sorted numbers of the nodes involved.
+    Scopes are keyed by the id of their function, the chunk is ``scope``.
+    A chunk that is not ``complete`` is only part of its scope, so names are
+    assumed to be captured by the functions of the part not seen.
+    """
+
+    def __init__(self, body: List[ast.AST], scope: ast.AST = None, *, complete=True, declared: set = None):
+        # the analyzed nodes stay alive, their ids cannot be reused while they are looked up
+        self.body = body
+        # id of a loop or function -> (its number, the number after its last node)
+        self.ranges = {}
+        # name -> numbers of its Name nodes, and of those not extended with +=
+        self.names = {}
+        self.loads = {}
+        # (scope key, name) -> count of Name nodes directly in that scope
+        self.own = {}
+        # scope key -> names declared global or nonlocal
+        self.declared = {}
+        # numbers and target names of the += of a name
+        self.append_numbers = []
+        self.append_names = []
+        self.exit_numbers = []
+        # numbers of the calls, str(x) apart as it may not be the builtin
+        self.call_numbers = []
+        self.str_call_numbers = []
+
+        root = key = None if scope is None else id(scope)
+        if declared is not None:
+            self.declared[root] = declared
+        targets = set()
+        number = 0
+        stack = list(reversed(body))
+        while stack:
+            node = stack.pop()
+            node_type = type(node)
+            if node_type is tuple:
+                # every node of a loop or function is numbered, the scope around it continues
+                node_key, start, key = node
+                self.ranges[node_key] = (start, number)
+                continue
+            if node_type in SCOPE_NODES:
+                stack.append((id(node), number, key))
+                if node_type in FUNCTION_NODES:
+                    key = id(node)
+            elif node_type is ast.Name:
+                self.names.setdefault(node.id, []).append(number)
+                self.own[key, node.id] = self.own.get((key, node.id), 0) + 1
+                if id(node) not in targets:
+                    self.loads.setdefault(node.id, []).append(number)
+            elif node_type is ast.AugAssign:
+                if isinstance(node.op, ast.Add) and isinstance(node.target, ast.Name):
+                    self.append_numbers.append(number)
+                    self.append_names.append(node.target.id)
+                    targets.add(id(node.target))
+            elif node_type is ast.Call:
+                if (isinstance(node.func, ast.Name) and node.func.id == "str" and len(node.args) == 1
+                        and not node.keywords):
+                    self.str_call_numbers.append(number)
                 else:
-                    generated_code += indent + "else\n"
-                    generated_code += indent + \
-                        handle_body(node.orelse, indent=4)
-            generated_code += indent + "end\n"
-        elif isinstance(node, ast.While):
-            generated_code += indent + "while " + \
-                unparse_expr(node.test) + " do\n"
-            generated_code += indent + handle_body(node.body, indent=4)
-            generated_code += indent + "end\n"
-        elif isinstance(node, ast.Pass):
+                    self.call_numbers.append(number)
+            elif node_type in EXIT_NODES:
+                self.exit_numbers.append(number)
+            elif node_type is ast.Global or node_type is ast.Nonlocal:
+                self.declared.setdefault(key, set()).update(node.names)
+            number += 1
+
+            fields = CHILD_FIELDS.get(node_type)
+            if fields is None:
+                fields = CHILD_FIELDS[node_type] = tuple(field for field in node_type._fields if field not in ("ctx", "op", "ops"))
+            children = []
+            for field in fields:
+                value = getattr(node, field, None)
+                if isinstance(value, list):
+                    children += [child for child in value if isinstance(child, ast.AST)]
+                elif isinstance(value, ast.AST):
+                    children.append(value)
+            stack += reversed(children)
+        if complete:
+            self.ranges[root] = (0, number)
+
+    def has_range(self, node: ast.AST):
+        return id(node) in self.ranges
+
+    def _count(self, numbers: list, key):
+        """Returns how many of the sorted ``numbers`` are inside the loop or scope ``key``"""
+        start, end = self.ranges[key]
+        return bisect.bisect_left(numbers, end) - bisect.bisect_left(numbers, start)
+
+    def exits(self, loop: ast.AST):
+        """Checks if ``loop`` returns or yields"""
+        return self._count(self.exit_numbers, id(loop)) > 0
+
+    def calls(self, loop: ast.AST, *, str_calls=False):
+        """Checks if ``loop`` calls a function, counting str(x) only with ``str_calls``"""
+        return self._count(self.call_numbers, id(loop)) > 0 or (str_calls and self._count(self.str_call_numbers, id(loop)) > 0)
+
+    def appended(self, loop: ast.AST):
+        """Returns the names ``loop`` extends with +=, in order and possibly repeated"""
+        start, end = self.ranges[id(loop)]
+        return self.append_names[bisect.bisect_left(self.append_numbers, start):bisect.bisect_left(self.append_numbers, end)]
+
+    def uses(self, loop: ast.AST, name: str):
+        """Checks if ``loop`` uses ``name`` other than extending it with +="""
+        return self._count(self.loads.get(name, []), id(loop)) > 0
+
+    def is_declared(self, key, name: str):
+        """Checks if the scope ``key`` declares ``name`` global or nonlocal"""
+        return name in self.declared.get(key, ())
+
+    def captures(self, key, name: str):
+        """
+        Checks if a function nested in the scope ``key`` uses ``name``, it
+        then sees every change of it, or if the scope declares it global or nonlocal
+        """
+        if self.is_declared(key, name) or key not in self.ranges:
+            return True
+        return self._count(self.names.get(name, []), key) > self.own.get((key, name), 0)
+
+
+def top_level_body(tree: ast.Module):
+    """The top level statements of a module, without its docstring and ``if __name__ == "__main__":`` guard"""
+    return [node for node in tree.body if not is_docstring(node) and not is_main_guard(node)]
+
+
+def generate_header():
+    return f"-- File auto generated by PyLua v{__version__}\n-- https://github.com/AsyncFor/pyluatranspiler/\n\n"
+
+
+def find_main(tree: ast.Module):
+    """Returns the ``main`` function definition of a module"""
+    root = None
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef):
+            if node.name == "main":
+                root = node
+
+    if root is None:
+        raise Exception("No main function found in the input file")
+    return root
+
+
+DEFAULT_CACHE_DIR = ".pylua_cache"
+DEFAULT_CACHE_SIZE = 64 * 1024 * 1024
+
+
+def source_digest(path: str = __file__):
+    """Returns the sha256 of the transpiler source, any change to it can change the generated lua"""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+TRANSPILER_DIGEST = source_digest()
+
+
+class TranspileCache:
+    """
+    On disk cache of generated lua.
+    Entries are keyed by the hash of the python source, the transpiler
+    version, the hash of the transpiler source and the options used, so
+    unchanged files skip parsing entirely.
+    Once the cache grows past ``max_size`` bytes the least recently used
+    entries are evicted.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, *, max_size: int = DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(source: str, options: dict = None) -> str:
+        digest = hashlib.sha256()
+        digest.update(__version__.encode())
+        digest.update(TRANSPILER_DIGEST.encode())
+        digest.update(repr(sorted((options or {}).items())).encode())
+        digest.update(source.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key: str):
+        return os.path.join(self.directory, key[:2], key + ".lua")
+
+    def get(self, key: str):
+        """Returns the cached lua for ``key`` or None"""
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding="utf-8") as f:
+                output = f.read()
+        except OSError:
+            self.misses += 1
+            return None
+        # refresh the modification time, eviction drops the oldest entries
+        try:
+            os.utime(path)
+        except OSError:
+            # evicted by another process since it was read, the output is still valid
             pass
-        elif isinstance(node, ast.Return):
-            generated_code += indent + "return " + \
-                unparse_expr(node.value) + "\n"
-        elif isinstance(node, ast.FunctionDef):
-            if "anon" in (dec.id for dec in node.decorator_list) and "local" in (dec.id for dec in node.decorator_list):
-                generated_code += indent + \
-                    f"local {node.name} = function" + \
-                    "(" + \
-                    ", ".join([arg.arg for arg in node.args.args]) + ")\n"
-                generated_code += indent + handle_body(node.body, indent=4)
-                generated_code += indent + "end\n"
-            elif "local" in (dec.id for dec in node.decorator_list):
-                generated_code += indent + "local function " + node.name + \
-                    "(" + \
-                    ", ".join([arg.arg for arg in node.args.args]) + ")\n"
-                generated_code += indent + handle_body(node.body, indent=4)
-                generated_code += indent + "end\n"
-            elif "anon" in (dec.id for dec in node.decorator_list):
-                generated_code += indent + \
-                    "function(" + \
-                    ", ".join([arg.arg for arg in node.args.args]) + ")\n"
-                generated_code += indent + handle_body(node.body, indent=4)
-                generated_code += indent + "end\n"
+        self.hits += 1
+        return output
+
+    def put(self, key: str, output: str):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, parallel jobs may store the same key
+        temp = f"{path}.{os.getpid()}.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            f.write(output)
+        os.replace(temp, path)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits ``max_size``"""
+        entries = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    status = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((status.st_mtime, status.st_size, path))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+
+    def stats(self):
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        return f"Cache: {self.hits} hits, {self.misses} misses ({ratio:.1f}% hit rate)"
+
+
+def transpile_file(input_file: str, output_file: str, *, cache: TranspileCache = None, options: dict = None):
+    """
+    Transpiles ``input_file`` and writes the result to ``output_file``.
+    ``options`` are passed to the Transpiler.
+    Returns True if the output was served from ``cache``.
+    """
+    with open(input_file, 'r', encoding="utf-8") as f:
+        input_py = f.read()
+
+    transpiler = Transpiler(**(options or {}))
+    output = None
+    if cache is not None:
+        key = cache.key(input_py, transpiler.options)
+        output = cache.get(key)
+    hit = output is not None
+    if not hit:
+        output = transpiler.transpile(input_py)
+        if cache is not None:
+            cache.put(key, output)
+
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(output)
+    return hit
+
+
+def _transpile_job(job):
+    """
+    Runs a single batch job.
+    Returns the error message if it failed and whether the cache was hit.
+    """
+    input_file, output_file, cache_dir, options = job
+    cache = TranspileCache(cache_dir) if cache_dir is not None else None
+    try:
+        return None, transpile_file(input_file, output_file, cache=cache, options=options)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}", False
+
+
+def _run_pool(sources: list, indices: list, jobs: int, results: dict):
+    """
+    Runs the batch jobs ``sources[index]`` for every index of ``indices`` on
+    a new process pool, storing their results into ``results``. Returns the
+    indices left unfinished because a worker process died, which breaks the
+    whole pool. The job that crashed is always one of them.
+    """
+    unfinished = []
+    with ProcessPoolExecutor(max_workers=min(jobs, len(indices))) as executor:
+        futures = []
+        for position, index in enumerate(indices):
+            try:
+                futures.append((index, executor.submit(_transpile_job, sources[index])))
+            except BrokenProcessPool:
+                # a worker died while the rest were still being submitted
+                unfinished += indices[position:]
+                break
+        for index, future in futures:
+            try:
+                results[index] = future.result()
+            except BrokenProcessPool:
+                unfinished.append(index)
+            except Exception as e:
+                results[index] = f"{type(e).__name__}: {e}", False
+    return unfinished
+
+
+def find_sources(input_dir: str, output_dir: str):
+    """
+    Walks ``input_dir`` for python files and pairs each of them with its
+    mirrored lua path inside ``output_dir``
+    """
+    jobs = []
+    for dirpath, dirnames, filenames in os.walk(input_dir):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith(".") and d != "__pycache__")
+        for filename in sorted(filenames):
+            if not filename.endswith(".py"):
+                continue
+            input_file = os.path.join(dirpath, filename)
+            relative = os.path.relpath(input_file, input_dir)
+            output_file = os.path.join(output_dir, os.path.splitext(relative)[0] + ".lua")
+            jobs.append((input_file, output_file))
+    return jobs
+
+
+def find_module(name: str, base_dir: str):
+    """
+    Returns the path of the python module ``name`` inside ``base_dir``, the
+    directory of a namespace package without ``__init__.py``, or None
+    """
+    path = os.path.join(base_dir, *name.split("."))
+    for candidate in (path + ".py", os.path.join(path, "__init__.py")):
+        if os.path.isfile(candidate):
+            return candidate
+    if os.path.isdir(path):
+        return path
+    return None
+
+
+def module_prefixes(name: str):
+    """Yields ``name`` and the packages holding it, outermost first"""
+    parts = name.split(".")
+    for end in range(1, len(parts) + 1):
+        yield ".".join(parts[:end])
+
+
+def imported_modules(tree: ast.AST):
+    """
+    Yields the names of the modules imported anywhere in ``tree``, with their
+    packages. Every name imported from a module could be a submodule of it.
+    """
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                yield from module_prefixes(alias.name)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            yield from module_prefixes(node.module)
+            yield from (f"{node.module}.{alias.name}" for alias in node.names if alias.name != "*")
+
+
+def bundle_file(input_file: str, output_file: str, *, options: dict = None, profiler: Profiler = None, source_map: bool = False):
+    """
+    Transpiles ``input_file`` and every module reachable through its imports
+    into ``output_file``. Modules are looked up next to ``input_file``, the
+    ones that cannot be found are left to ``require`` at runtime.
+    With ``source_map`` the mappings are written to ``output_file`` + ".map".
+    Only the imports of ``main`` are followed, or all of them with all_definitions.
+    """
+    base_dir = os.path.dirname(os.path.abspath(input_file))
+    with open(input_file, 'r', encoding="utf-8") as f:
+        tree = parse_source(f.read())
+
+    modules = {}
+    paths = {}
+    if (options or {}).get("all_definitions"):
+        pending = [name for node in top_level_body(tree) for name in imported_modules(node)]
+    else:
+        pending = list(imported_modules(find_main(tree)))
+    while pending:
+        name = pending.pop(0)
+        if name in modules:
+            continue
+        path = find_module(name, base_dir)
+        if path is None:
+            continue
+        if os.path.isdir(path):
+            # a namespace package, it only holds its submodules
+            modules[name] = ast.Module(body=[], type_ignores=[])
+            paths[name] = path
+            continue
+        with open(path, 'r', encoding="utf-8") as f:
+            modules[name] = parse_source(f.read())
+        paths[name] = path
+        pending.extend(imported_modules(modules[name]))
+
+    mappings = SourceMap([input_file], file=os.path.basename(output_file)) if source_map else None
+    output = Transpiler(**(options or {}), profiler=profiler).transpile_bundle(tree, modules, source_map=mappings)
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(output)
+    if mappings is not None:
+        mappings.sources = [paths.get(source, source) for source in mappings.sources]
+        save_source_map(mappings, output_file)
+
+
+def save_source_map(source_map: SourceMap, output_file: str):
+    """Writes ``source_map`` next to ``output_file``, with sources relative to it"""
+    directory = os.path.dirname(os.path.abspath(output_file))
+    source_map.sources = [os.path.relpath(os.path.abspath(source), directory) for source in source_map.sources]
+    source_map.save(output_file + ".map")
+
+
+def run_batch(input_dir: str, output_dir: str, *, jobs=None, cache: TranspileCache = None, options: dict = None):
+    """
+    Transpiles every python file below ``input_dir`` into ``output_dir``,
+    spreading the files over ``jobs`` processes. Errors are reported per
+    file and do not stop the run. Returns the number of failed files.
+    """
+    cache_dir = cache.directory if cache is not None else None
+    stored = 0
+    sources = [(input_file, output_file, cache_dir, options) for input_file, output_file in find_sources(input_dir, output_dir)]
+    jobs = jobs or os.cpu_count() or 1
+    start = time.perf_counter()
+    failed = 0
+    if jobs == 1 or len(sources) <= 1:
+        results = dict(enumerate(map(_transpile_job, sources)))
+    else:
+        results = {}
+        groups = [list(range(len(sources)))]
+        while groups:
+            unfinished = _run_pool(sources, groups.pop(), jobs, results)
+            if len(unfinished) == 1:
+                # nothing else was left, so this is the job whose worker died
+                results[unfinished[0]] = "BrokenProcessPool: the worker process died while transpiling this file", False
+            elif unfinished:
+                # the jobs of the broken pool are retried on new pools, halving
+                # them until the one that crashed is the only one left
+                middle = len(unfinished) // 2
+                groups += [unfinished[middle:], unfinished[:middle]]
+
+    for index, (input_file, _, _, _) in enumerate(sources):
+        error, hit = results[index]
+        if error is not None:
+            failed += 1
+            print(f"{input_file}: {error}", file=sys.stderr)
+        elif cache is not None:
+            if hit:
+                cache.hits += 1
             else:
-                generated_code += indent + "function " + node.name + \
-                    "(" + \
-                    ", ".join([arg.arg for arg in node.args.args]) + ")\n"
-                generated_code += indent + handle_body(node.body, indent=4)
-                generated_code += indent + "end\n"
-        elif isinstance(node, ast.Try):
-            if len(node.handlers) == 1 and len(node.handlers[0].body) == 1 and isinstance(node.handlers[0].body[0], ast.Pass):
-                generated_code += indent + "pcall(function()\n"
-                generated_code += indent + handle_body(node.body, indent=4)
-                generated_code += indent + "end)\n"
+                cache.misses += 1
+                stored += 1
+
+    elapsed = time.perf_counter() - start
+    rate = len(sources) / elapsed if elapsed > 0 else 0
+    print(f"Transpiled {len(sources) - failed}/{len(sources)} files in {elapsed:.2f}s ({rate:.1f} files/s), {failed} failed")
+    if cache is not None:
+        # only new entries can push the cache past its size
+        if stored:
+            cache.evict()
+        print(cache.stats())
+    return failed
+
+
+def watch(input_path: str, output_path: str, *, interval=0.5, cache: TranspileCache = None, options: dict = None):
+    """
+    Keeps transpiling ``input_path`` (a file or a directory) whenever one of
+    its python files changes, until interrupted
+    """
+    mtimes = {}
+    try:
+        while True:
+            if os.path.isdir(input_path):
+                sources = find_sources(input_path, output_path)
             else:
-                generated_code += indent + "xpcall(function()\n"
-                generated_code += indent + handle_body(node.body, indent=4)
-                generated_code += indent + "end, function(err)\n"
-                generated_code += indent + handle_body(node.handlers)
-                generated_code += indent + "end)\n"
-        elif isinstance(node, ast.Break):
-            generated_code += indent + "break\n"
-        elif isinstance(node, ast.Raise):
-            generated_code += indent + \
-                "error(" + unparse_expr(node.exc) + ")\n"
-        elif isinstance(node, ast.ExceptHandler):
-            generated_code += indent + handle_body(node.body, indent=4)
-        elif isinstance(node, ast.Import):
-            for names in node.names:
-                name = names.name
-                generated_code += indent + \
-                    f"local {names.asname or name} = " + \
-                    f"require('{names.name}.lua')\n"
-        elif isinstance(node, ast.ImportFrom):
-            for names in node.names:
-                name = names.name
-                if name == "*":
-                    generated_code += indent + f"for _, v in next, require('{node.module}.lua') do\n"
-                    generated_code += indent + f"    getfenv()[v] = require('{node.module}.lua')[v]\n"
-                    generated_code += indent + "end\n"
-                else:
-                    generated_code += indent + \
-                        f"local {names.asname or name} = " + \
-                        f"require('{node.module}.lua').{names.name}\n"
-        elif isinstance(node, ast.AsyncFunctionDef):
-            generated_code += indent + \
-                f"local {node.name} = coroutine.create(function({', '.join([arg.arg for arg in node.args.args])})\n"
-            generated_code += indent + handle_body(node.body, indent=4)
-            generated_code += indent + "end)\n"
-        elif isinstance(node, ast.Await):
-            generated_code += f"coroutine.resume({unparse_expr(node.value)})\n"
-        elif isinstance(node, ast.Lambda):
-            generated_code += indent + "function " + \
-                unparse_expr(node.args) + "\n"
-            generated_code += indent + handle_body(node.body, indent=4)
-            generated_code += indent + "end\n"
-        elif isinstance(node, ast.AnnAssign):
-            if node.annotation.id == "local":
-                generated_code += indent + \
-                    f"local {unparse_expr(node.target)} = " + \
-                    unparse_expr(node.value) + "\n"
-        elif isinstance(node, ast.AugAssign):
-            generated_code += indent + \
-                unparse_expr(node.target) + " = " + \
-                unparse_expr(node.target) + " " + \
-                unparse_expr(node.op) + " " + \
-                unparse_expr(node.value) + "\n"
-        else:
-            raise NotImplementedError(node)
-    return generated_code
+                sources = [(input_path, output_path)]
+            stored = False
+
+            for input_file, output_file in sources:
+                try:
+                    mtime = os.stat(input_file).st_mtime_ns
+                except OSError:
+                    continue
+                if mtimes.get(input_file) == mtime:
+                    continue
+                mtimes[input_file] = mtime
+                start = time.perf_counter()
+                try:
+                    if not transpile_file(input_file, output_file, cache=cache, options=options):
+                        stored = True
+                except Exception as e:
+                    print(f"{input_file}: {type(e).__name__}: {e}", file=sys.stderr)
+                    continue
+                print(f"{input_file} -> {output_file} ({(time.perf_counter() - start)*1000:.1f}ms)")
+            if stored and cache is not None:
+                cache.evict()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def handle_request(transpiler: Transpiler, request: str):
+    """
+    Answers a single server request.
+    A request is a json object with the python ``source`` and an optional
+    ``id``, the response carries the same ``id`` and either ``lua`` or ``error``.
+    """
+    try:
+        request = json.loads(request)
+        if not isinstance(request, dict):
+            raise ValueError("a request must be a json object")
+        response = {"lua": transpiler.transpile(request["source"])}
+    except Exception as e:
+        request = request if isinstance(request, dict) else {}
+        response = {"error": f"{type(e).__name__}: {e}"}
+    if "id" in request:
+        response["id"] = request["id"]
+    return json.dumps(response)
+
+
+def serve(instream=None, outstream=None, *, options: dict = None):
+    """Answers json requests, one per line, from ``instream`` until it is closed"""
+    instream = instream or sys.stdin
+    outstream = outstream or sys.stdout
+    transpiler = Transpiler(**(options or {}))
+    for line in instream:
+        if not line.strip():
+            continue
+        outstream.write(handle_request(transpiler, line) + "\n")
+        outstream.flush()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        transpiler = Transpiler(**self.server.options)
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            self.wfile.write((handle_request(transpiler, line.decode("utf-8")) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+def serve_socket(path: str, *, options: dict = None):
+    """Same as serve, but answers every connection to the unix socket at ``path``"""
+    if os.path.exists(path):
+        # a socket left behind by an earlier server, anything else is not ours to remove
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise FileExistsError(f"{path} exists and is not a socket")
+        os.remove(path)
+    with socketserver.ThreadingUnixStreamServer(path, _RequestHandler) as server:
+        server.options = options or {}
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    os.remove(path)
+
+
+def print_profile(profiler: Profiler, json_file: str = None):
+    """Prints the report of ``profiler`` to stderr, or writes it to ``json_file``"""
+    if profiler is None:
+        return
+    if json_file:
+        with open(json_file, "w", encoding="utf-8") as f:
+            json.dump(profiler.to_json(), f, indent=2)
+    else:
+        print(profiler.report(), file=sys.stderr)
+
 
 __version__ = "0.1.0"
 if __name__ == "__main__":
@@ -428,35 +2845,110 @@ if __name__ == "__main__":
         epilog="Version: " + __version__,
         )
     
-    parser.add_argument("input", help="Input file to transpile", type=str)
-    parser.add_argument("output", help="The transpiled output file", type=str)
+    parser.add_argument("input", help="Input file (or directory with --batch) to transpile", type=str, nargs="?")
+    parser.add_argument("output", help="The transpiled output file (or directory with --batch)", type=str, nargs="?")
     parser.add_argument("-v", "--version", action="version", version=__version__)
     parser.add_argument("-d", "--debug", action="store_true", help="enable debug mode")
+    parser.add_argument("-b", "--batch", action="store_true", help="transpile every python file of the input directory into the output directory")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of processes used by --batch, defaults to the cpu count")
+    parser.add_argument("--no-cache", action="store_true", help="always transpile, ignoring and not updating the build cache")
+    parser.add_argument("--cache-dir", type=str, default=DEFAULT_CACHE_DIR, help=f"directory of the build cache, defaults to {DEFAULT_CACHE_DIR}")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE // (1024*1024), help="maximum size of the build cache in megabytes")
+    parser.add_argument("-w", "--watch", action="store_true", help="keep running and transpile the input again whenever it changes")
+    parser.add_argument("--server", action="store_true", help="answer json requests with python source on stdin with the transpiled lua on stdout")
+    parser.add_argument("--socket", type=str, default=None, help="answer --server requests on this unix socket instead of stdin")
+    parser.add_argument("-O", "--optimize", action="store_true", help="generate faster lua: localized iterator functions, table appends without table.insert and ipairs loops over lists")
+    parser.add_argument("--bundle", action="store_true", help="transpile the input and every python module it imports into a single lua file")
+    parser.add_argument("--tree-shake", action="store_true", help="leave out functions, imports and locals that main never reaches")
+    parser.add_argument("--profile", action="store_true", help="print the time spent per node type, the nesting depth of handlers and the size of every top level function")
+    parser.add_argument("--profile-json", type=str, default=None, help="write the --profile report as json to this file")
+    parser.add_argument("--source-map", action="store_true", help="write a source map from the generated lua lines to the python lines next to the output")
+    parser.add_argument("--translate", type=str, default=None, metavar="MAP", help="rewrite the lua line numbers of a traceback read from stdin to python lines using a source map")
+    parser.add_argument("--instrument", action="store_true", help="count calls and time of every generated function at runtime, __profile_dump() prints the results")
+    parser.add_argument("--minify", action="store_true", help="strip whitespace and comments, shorten local names and merge local declarations")
+    parser.add_argument("--pool-strings", action="store_true", help="with --minify, declare repeated string constants once as locals")
+    parser.add_argument("--all-definitions", action="store_true", help="transpile every top level statement of the input instead of the body of main")
+    parser.add_argument("--stream", action="store_true", help="read, transpile and write the input one top level statement at a time to keep memory bounded")
     args = parser.parse_args()
+    options = {"optimize": args.optimize, "tree_shake": args.tree_shake, "instrument": args.instrument,
+               "minify": args.minify or args.pool_strings, "pool_strings": args.pool_strings,
+               "all_definitions": args.all_definitions}
+    if args.all_definitions and args.tree_shake:
+        parser.error("--tree-shake keeps what main reaches, it cannot be combined with --all-definitions")
+    if args.stream and (args.minify or args.pool_strings or args.tree_shake or args.bundle or args.batch or args.watch or args.server):
+        parser.error("--stream transpiles a single file statement by statement, it cannot be combined with "
+                     "--minify, --pool-strings, --tree-shake, --bundle, --batch, --watch or --server")
+    profiler = Profiler() if args.profile or args.profile_json else None
+
+    if args.translate:
+        sys.stdout.write(SourceMap.load(args.translate).translate(sys.stdin.read()))
+        sys.exit(0)
+    if args.server:
+        if args.socket:
+            try:
+                serve_socket(args.socket, options=options)
+            except FileExistsError as e:
+                parser.error(str(e))
+        else:
+            serve(options=options)
+        sys.exit(0)
+    if args.input is None or args.output is None:
+        parser.error("the following arguments are required: input, output")
 
     input_file = args.input
     output_file = args.output
     is_debug = args.debug
-    with open(input_file, 'r', encoding="utf-8") as f:
-        input_py = f.read()
+    cache = None
+    if not args.no_cache:
+        cache = TranspileCache(args.cache_dir, max_size=args.cache_size*1024*1024)
 
-    parsed = ast.parse(input_py)
+    if args.bundle:
+        bundle_file(input_file, output_file, options=options, profiler=profiler, source_map=args.source_map)
+        print_profile(profiler, args.profile_json)
+        sys.exit(0)
 
-    root = None
-    for node in parsed.body:
-        if isinstance(node, ast.FunctionDef):
-            if node.name == "main":
-                root = node
+    if args.watch:
+        watch(input_file, output_file, cache=cache, options=options)
+        sys.exit(0)
 
-    if root is None:
-        raise Exception("No main function found in the input file")
+    if args.batch or os.path.isdir(input_file):
+        sys.exit(1 if run_batch(input_file, output_file, jobs=args.jobs, cache=cache, options=options) else 0)
+
+    if args.stream:
+        source_map = SourceMap([input_file], file=os.path.basename(output_file)) if args.source_map else None
+        transpiler = Transpiler(**options, profiler=profiler)
+        with open(input_file, "r", encoding="utf-8") as source, open(output_file, "w", encoding="utf-8") as f:
+            transpiler.transpile_stream(parse_top_level(source.readline), f, source_map=source_map)
+        if source_map is not None:
+            save_source_map(source_map, output_file)
+        print_profile(profiler, args.profile_json)
+        sys.exit(0)
+
+    if cache is not None and not is_debug and profiler is None and not args.source_map:
+        if not transpile_file(input_file, output_file, cache=cache, options=options):
+            cache.evict()
+        sys.exit(0)
+
+    with open(input_file, 'r', encoding="utf-8") as f:
+        input_py = f.read()
+
+    transpiler = Transpiler(**options, profiler=profiler)
+    parsed = transpiler.prepare(parse_source(input_py))
+    body, _ = transpiler.chunk_body(parsed, {})
 
     if is_debug:    
         print("-"*10, "DUMPED AST TREE", "-"*10)
-        print(ast.dump(root, indent=2))
+        print(ast.dump(parsed if transpiler.all_definitions else find_main(parsed), indent=2))
         print("-"*30)
 
-    output = f"-- File auto generated by PyLua v{__version__}\n-- https://github.com/AsyncFor/pyluatranspiler/\n\n" + handle_body(
-        root.body)
+    source_map = SourceMap([input_file], file=os.path.basename(output_file)) if args.source_map else None
     with open(output_file, "w", encoding="utf-8") as f:
-        f.write(output)
\ No newline at end of file
+        # minified output needs the whole chunk first
+        out = Emitter(None if transpiler.minify else f, source_map=source_map)
+        out.write(generate_header())
+        transpiler.emit_chunk(body, out)
+        if transpiler.minify:
+            f.write(transpiler.finish(out.getvalue(), source_map))
+    if source_map is not None:
+        save_source_map(source_map, output_file)
+    print_profile(profiler, args.profile_json)
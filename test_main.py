@@ -0,0 +1,694 @@
+"""
+Tests for the transpiler. Generated lua runs on a lua 5.1 runtime (lupa)
+and must print the same as the python program, with and without the
+optional passes.
+
+usage: python3 -m pytest test_main.py
+"""
+
+import io
+import os
+import ast
+import sys
+import json
+
+import pytest
+
+import main
+from main import Transpiler, Emitter, Profiler, SourceMap, parse_source, parse_top_level, top_level_sources
+
+lupa = pytest.importorskip("lupa.lua51")
+
+# print collects its output instead of writing to stdout
+CAPTURE_PRINT = """print = function(...)
+    local parts = {}
+    for i = 1, select("#", ...) do
+        parts[i] = tostring(select(i, ...))
+    end
+    __output(table.concat(parts, " "))
+end
+"""
+
+PROGRAM = '''
+DEBUG = False
+
+
+def main():
+    @local
+    def describe(name, count):
+        return f"{name} has {count} items"
+
+    def unused(value):
+        return value * 2
+
+    greeting = "hello"
+    total = 0
+    for i in [1, 2, 3, 4]:
+        total += i * 2 + 1
+    if DEBUG:
+        print("debug")
+    text = ""
+    for word in ["a", "b", "c"]:
+        text += word + "-"
+    print(greeting, total, text)
+    print(describe("basket", total))
+    print(describe("box", 3 * 4 + 1))
+    print("hello", "hello", "hello", "hello")
+'''
+
+EXPECTED = ["hello 24 a-b-c-", "basket has 24 items", "box has 13 items", "hello hello hello hello"]
+
+
+def execute(lua: str):
+    """Runs ``lua`` and returns the lines it printed"""
+    runtime = lupa.LuaRuntime()
+    output = []
+    runtime.globals()["__output"] = output.append
+    runtime.execute(CAPTURE_PRINT)
+    runtime.execute(lua)
+    return output
+
+
+def run(source: str, **options):
+    return execute(Transpiler(**options).transpile(source))
+
+
+def lua_line(lua: str, text: str):
+    """Returns the 1 based number of the first lua line containing ``text``"""
+    for lineno, line in enumerate(lua.splitlines(), 1):
+        if text in line:
+            return lineno
+    raise AssertionError(f"{text!r} not found in {lua}")
+
+
+@pytest.mark.parametrize("options", [
+    {},
+    {"optimize": True},
+    {"tree_shake": True},
+    {"instrument": True},
+    {"minify": True},
+    {"minify": True, "pool_strings": True},
+    {"optimize": True, "tree_shake": True, "minify": True, "pool_strings": True},
+])
+def test_program_output(options):
+    assert run(PROGRAM, **options) == EXPECTED
+
+
+def test_emitter_indentation():
+    out = Emitter(indent=2)
+    out.line("a")
+    with out.indented():
+        out.line("b")
+        out.lines("c\nd\n")
+        with out.indented():
+            out.write("raw\n")
+    out.line()
+    out.line("e")
+    assert out.getvalue() == "  a\n      b\n      c\n      d\nraw\n  \n  e\n"
+    assert out.size == len(out.getvalue())
+    assert out.lineno == 8
+
+
+def test_emitter_streams_to_file():
+    stream = io.StringIO()
+    out = Emitter(stream)
+    out.line("local x = 1")
+    with out.indented():
+        out.lines("print(x)")
+    assert stream.getvalue() == "local x = 1\n    print(x)\n"
+    # nothing is kept in the buffer
+    assert out.getvalue() == ""
+
+
+def test_emitter_lines_split_on_newlines_only():
+    out = Emitter()
+    out.lines('x = "a\x0cb\x1cc\u2028d"\ny = 1')
+    assert out.getvalue() == 'x = "a\x0cb\x1cc\u2028d"\ny = 1\n'
+    assert out.lineno == 3
+
+
+def test_handle_body_returns_lua():
+    body = ast.parse("x = 1\nif x:\n    print(x)\n").body
+    expected = "    local x = 1\n    if x then\n        print(x)\n    end\n"
+    assert Transpiler().handle_body(body, indent=4) == expected
+    # the module level function of the old api keeps working
+    assert main.handle_body(body, indent=4) == expected
+
+
+def test_minify_shrinks_output():
+    plain = Transpiler().transpile(PROGRAM)
+    minified = Transpiler(minify=True).transpile(PROGRAM)
+    pooled = Transpiler(minify=True, pool_strings=True).transpile(PROGRAM)
+    assert len(pooled) < len(minified) < len(plain)
+    # the repeated constant is declared once
+    assert pooled.count('"hello"') == 1
+
+
+def test_minify_keeps_globals():
+    lua = Transpiler(minify=True).transpile(PROGRAM)
+    assert "function describe" not in lua
+    assert "function unused(" in lua
+    assert "print(" in lua
+
+
+def test_minify_keeps_table_fields():
+    source = "def main():\n    settings = {\"width\": 2}\n    settings.height = settings.width + 1\n    print(settings.height)\n"
+    lua = Transpiler(minify=True).transpile(source)
+    assert "settings" not in lua
+    assert '["width"]=2' in lua
+    assert ".height=" in lua and ".width+1" in lua
+    assert execute(lua) == ["3"]
+
+
+def test_nested_function_locals():
+    source = '''
+def main():
+    x = 1
+    y = 1
+    @local
+    def shadow():
+        x = 2
+        return x
+    @local
+    def update():
+        nonlocal y
+        y = 3
+    print(shadow(), x)
+    update()
+    print(y)
+'''
+    assert run(source) == ["2 1", "3"]
+
+
+def test_global_assignment_is_not_local():
+    source = "def main():\n    global count\n    count = 1\n    print(count)\n"
+    lua = Transpiler().transpile(source)
+    assert "local count" not in lua
+    assert execute(lua) == ["1"]
+
+
+def test_top_level_sources():
+    source = '''"""docs"""
+# comment
+LIMIT = 3
+
+@decorate
+def first():
+    return 1
+if LIMIT:
+    pass
+else:
+    pass
+values = [
+1, 2]
+'''
+    lines = iter(source.splitlines(keepends=True))
+    segments = list(top_level_sources(lambda: next(lines, "")))
+    assert [lineno for lineno, _ in segments] == [1, 3, 5, 8, 12]
+    assert "".join(text for _, text in segments) == source
+
+
+def test_stream_matches_whole_module(tmp_path):
+    source = PROGRAM + "\n\ndef helper(x):\n    return x + 1\n\nprint(helper(1))\n"
+    path = tmp_path / "program.py"
+    path.write_text(source)
+    output = tmp_path / "program.lua"
+    with open(path, encoding="utf-8") as f, open(output, "w", encoding="utf-8") as out:
+        Transpiler(all_definitions=True).transpile_stream(parse_top_level(f.readline), out)
+    streamed = output.read_text()
+    assert streamed == Transpiler(all_definitions=True).transpile(source)
+    assert execute(streamed + "\nmain()\n") == ["2", *EXPECTED]
+
+
+def test_stream_parses_statements_in_place(monkeypatch):
+    def no_thread():
+        raise AssertionError("small statements should not need the parsing thread")
+    monkeypatch.setattr(main, "_parse_thread", no_thread)
+    lines = iter((PROGRAM * 20).splitlines(keepends=True))
+    assert len(list(parse_top_level(lambda: next(lines, "")))) == 40
+
+
+def _dying_job(job):
+    if job[0].endswith("crash.py"):
+        os._exit(1)
+    return _transpile_job(job)
+
+
+_transpile_job = main._transpile_job
+
+
+@pytest.mark.parametrize("crash", ["crash", "m_crash", "z_crash"])
+def test_batch_survives_crashed_worker(tmp_path, monkeypatch, capsys, crash):
+    source_dir = tmp_path / "src"
+    source_dir.mkdir()
+    names = [crash, *(f"file{i:02d}" for i in range(39))]
+    for name in names:
+        (source_dir / f"{name}.py").write_text("def main():\n    print(1)\n")
+    monkeypatch.setattr(main, "_transpile_job", _dying_job)
+    failed = main.run_batch(str(source_dir), str(tmp_path / "out"), jobs=2, options={})
+    captured = capsys.readouterr()
+    assert failed == 1
+    assert f"{crash}.py" in captured.err
+    assert "39/40 files" in captured.out
+    assert len(list((tmp_path / "out").iterdir())) == 39
+
+
+class ExtendedTranspiler(Transpiler):
+    pass
+
+
+def _unparse_if_exp(transpiler, node):
+    return ["(", node.test, " and ", node.body, " or ", node.orelse, ")"]
+
+
+def _emit_assert(transpiler, node, out):
+    out.line("assert(" + transpiler.unparse_expr(node.test) + ")")
+
+
+ExtendedTranspiler.register_expr(ast.IfExp, _unparse_if_exp)
+ExtendedTranspiler.register_stmt(ast.Assert, _emit_assert)
+
+
+def test_register_handlers():
+    source = "def main():\n    x = 3\n    assert x > 2\n    print(1 if x > 2 else 2, 1 if x > 5 else 2)\n"
+    lua = ExtendedTranspiler().transpile(source)
+    assert "assert(x > 2)" in lua
+    assert "(x > 2 and 1 or 2)" in lua
+    assert execute(lua) == ["1 2"]
+    # the handlers are registered on the subclass only
+    with pytest.raises(NotImplementedError):
+        Transpiler().transpile(source)
+
+
+class TaggedName(ast.Name):
+    pass
+
+
+def test_handler_of_base_node_type():
+    tree = ast.parse("def main():\n    x = 3\n    print(x)\n")
+    call = tree.body[0].body[1].value
+    call.args[0].__class__ = TaggedName
+    assert execute(Transpiler().transpile_ast(tree)) == ["3"]
+    # the lookup through the base classes is cached for the subclass
+    assert Transpiler.expr_handlers[TaggedName] is Transpiler.expr_handlers[ast.Name]
+
+
+def test_cache_serves_unchanged_files(tmp_path):
+    source = tmp_path / "program.py"
+    source.write_text(PROGRAM)
+    cache = main.TranspileCache(str(tmp_path / "cache"))
+    assert not main.transpile_file(str(source), str(tmp_path / "first.lua"), cache=cache)
+    assert main.transpile_file(str(source), str(tmp_path / "second.lua"), cache=cache)
+    assert (tmp_path / "first.lua").read_text() == (tmp_path / "second.lua").read_text()
+    assert cache.key(PROGRAM, {"optimize": True}) != cache.key(PROGRAM, {"optimize": False})
+
+
+def test_cache_hit_survives_concurrent_eviction(tmp_path, monkeypatch):
+    cache = main.TranspileCache(str(tmp_path / "cache"))
+    key = cache.key(PROGRAM)
+    cache.put(key, "print(1)")
+
+    def evicted(path, *args, **kwargs):
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(main.os, "utime", evicted)
+    assert cache.get(key) == "print(1)"
+    assert cache.hits == 1
+
+
+def test_batch_evicts_only_after_storing(tmp_path, monkeypatch, capsys):
+    source_dir = tmp_path / "src"
+    source_dir.mkdir()
+    (source_dir / "program.py").write_text(PROGRAM)
+    cache = main.TranspileCache(str(tmp_path / "cache"))
+    evictions = []
+    monkeypatch.setattr(cache, "evict", lambda: evictions.append(True))
+    main.run_batch(str(source_dir), str(tmp_path / "out"), jobs=1, cache=cache, options={})
+    main.run_batch(str(source_dir), str(tmp_path / "out"), jobs=1, cache=cache, options={})
+    assert len(evictions) == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_key_changes_with_transpiler_source(monkeypatch):
+    key = main.TranspileCache.key(PROGRAM)
+    monkeypatch.setattr(main, "TRANSPILER_DIGEST", "0" * 64)
+    assert main.TranspileCache.key(PROGRAM) != key
+
+
+def test_serve_answers_requests():
+    source = "def main():\n    print(1)\n"
+    requests = [
+        json.dumps({"source": source}),
+        json.dumps({"id": 7, "source": source}),
+        "",
+        "{not json",
+        json.dumps([1, 2]),
+        json.dumps({"id": 9}),
+    ]
+    outstream = io.StringIO()
+    main.serve(io.StringIO("\n".join(requests) + "\n"), outstream)
+    plain, with_id, malformed, not_object, missing = map(json.loads, outstream.getvalue().splitlines())
+    assert "id" not in plain and execute(plain["lua"]) == ["1"]
+    assert with_id["id"] == 7 and with_id["lua"] == plain["lua"]
+    assert "id" not in malformed and malformed["error"].startswith("JSONDecodeError")
+    assert not_object == {"error": "ValueError: a request must be a json object"}
+    assert missing == {"id": 9, "error": "KeyError: 'source'"}
+
+
+def test_serve_socket_keeps_other_files(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("keep me")
+    with pytest.raises(FileExistsError):
+        main.serve_socket(str(path))
+    assert path.read_text() == "keep me"
+
+
+def test_watch_evicts_after_storing(tmp_path, monkeypatch, capsys):
+    source = tmp_path / "program.py"
+    source.write_text(PROGRAM)
+    cache = main.TranspileCache(str(tmp_path / "cache"))
+    evictions = []
+    monkeypatch.setattr(cache, "evict", lambda: evictions.append(True))
+    rounds = []
+
+    def sleep(interval):
+        rounds.append(interval)
+        if len(rounds) == 2:
+            raise KeyboardInterrupt
+    monkeypatch.setattr(main.time, "sleep", sleep)
+    main.watch(str(source), str(tmp_path / "program.lua"), cache=cache, options={})
+    # the second round finds nothing changed and stores nothing
+    assert len(evictions) == 1
+    assert execute((tmp_path / "program.lua").read_text()) == EXPECTED
+
+
+def test_constant_folding():
+    lua = Transpiler(optimize=True).transpile(PROGRAM)
+    assert "DEBUG" not in lua
+    assert '"debug"' not in lua
+    assert "3 * 4" not in lua and "13" in lua
+
+
+def test_constant_folding_keeps_reassigned_constants():
+    source = "LIMIT = 1\n\ndef main():\n    print(LIMIT)\n\ndef bump():\n    global LIMIT\n    LIMIT = 2\n"
+    assert "print(LIMIT)" in Transpiler(optimize=True).transpile(source)
+
+
+def test_circular_bundle_imports():
+    modules = {
+        "a": parse_source("import b\n\ndef ping(n):\n    if n == 0:\n        return 'done'\n    return b.pong(n - 1)\n"),
+        "b": parse_source("import a\n\ndef pong(n):\n    return a.ping(n)\n"),
+    }
+    tree = parse_source("def main():\n    import a\n    print(a.ping(3))\n")
+    assert execute(Transpiler().transpile_bundle(tree, modules)) == ["done"]
+
+
+def test_bundle_all_definitions(tmp_path):
+    (tmp_path / "helper.py").write_text("def add(a, b):\n    return a + b\n")
+    (tmp_path / "lib.py").write_text("import helper\n\ndef twice(x):\n    return helper.add(x, x)\n\nprint(twice(21))\n")
+    output = str(tmp_path / "lib.lua")
+    main.bundle_file(str(tmp_path / "lib.py"), output, options={"all_definitions": True})
+    with open(output, encoding="utf-8") as f:
+        assert execute(f.read()) == ["42"]
+
+
+@pytest.mark.parametrize("options", [{}, {"tree_shake": True}])
+def test_bundle_packages(tmp_path, options):
+    (tmp_path / "pkg").mkdir()
+    (tmp_path / "pkg" / "__init__.py").write_text("NAME = 'pkg'\n")
+    (tmp_path / "pkg" / "helpers.py").write_text("def add(a, b):\n    return a + b\n")
+    (tmp_path / "pkg" / "more.py").write_text("def double(x):\n    return x * 2\n")
+    (tmp_path / "space").mkdir()
+    (tmp_path / "space" / "tools.py").write_text("def negate(x):\n    return 0 - x\n")
+    (tmp_path / "program.py").write_text(
+        "def main():\n"
+        "    import pkg.helpers\n"
+        "    import space.tools as tools\n"
+        "    from pkg import more, NAME\n"
+        "    print(pkg.helpers.add(1, 2), more.double(4), tools.negate(5), NAME)\n"
+    )
+    output = str(tmp_path / "program.lua")
+    main.bundle_file(str(tmp_path / "program.py"), output, options=options)
+    with open(output, encoding="utf-8") as f:
+        assert execute(f.read()) == ["3 8 -5 pkg"]
+
+
+def test_tree_shake_drops_unreached_definitions():
+    assert "unused" in Transpiler().transpile(PROGRAM)
+    assert "unused" not in Transpiler(tree_shake=True).transpile(PROGRAM)
+
+
+def test_tree_shake_long_call_chain():
+    count = 1000
+    lines = ["def main():"]
+    for i in range(count - 1):
+        lines += [f"    def step{i}(x):", f"        return step{i + 1}(x) + 1"]
+    lines += [f"    def step{count - 1}(x):", "        return x", "    def unused():", "        return 0",
+              "    print(step0(0))"]
+    lua = Transpiler(tree_shake=True).transpile("\n".join(lines) + "\n")
+    assert "unused" not in lua
+    assert execute(lua) == [str(count - 1)]
+
+
+def test_benchmark_flags_emission_growing_with_depth():
+    import benchmark
+
+    def result(size, depth, nodes, emit_s):
+        return {"case": "nesting", "size": size, "depth": depth, "nodes": nodes, "emit_s": emit_s}
+
+    linear = [result(20, 4, 1000, 0.01), result(20, 32, 8000, 0.08), result(40, 4, 2000, 0.02)]
+    assert benchmark.check_scaling(linear) == []
+    quadratic = [result(20, 4, 1000, 0.01), result(20, 32, 8000, 0.64)]
+    assert benchmark.check_scaling(quadratic) == ["nesting size=20: emission grows as nodes^2.00 from depth 4 to 32"]
+
+
+def test_benchmark_compare_ignores_noise():
+    import benchmark
+
+    def result(emit_s, write_s=0.00001, parse_s=0.01, peak_memory_bytes=1000):
+        return {"case": "nesting", "size": 20, "depth": 4, "parse_s": parse_s, "emit_s": emit_s,
+                "write_s": write_s, "peak_memory_bytes": peak_memory_bytes}
+
+    baseline = {"results": [result(0.0002)]}
+    # microsecond phases and the parser may double without failing the run
+    assert benchmark.compare([result(0.0004, write_s=0.00003, parse_s=0.02)], baseline) == []
+    assert benchmark.compare([result(0.05)], baseline) == ["nesting size=20 depth=4: emit_s 0.0002 -> 0.05 (+24900%)"]
+    assert len(benchmark.compare([result(0.0002, peak_memory_bytes=2000)], baseline)) == 1
+
+
+def deep_tree(expression: ast.expr, source: str = "def main():\n    x = 0\n"):
+    """
+    The module of ``source`` with ``expression`` as the value of the first
+    assignment to x in main, built without the parser and its nesting limits
+    """
+    tree = ast.parse(source)
+    assign = next(node for node in tree.body[0].body if isinstance(node, ast.Assign) and node.targets[0].id == "x")
+    assign.value = expression
+    return tree
+
+
+def add_chain(count: int):
+    expression = ast.Name("a", ast.Load())
+    for _ in range(count - 1):
+        expression = ast.BinOp(expression, ast.Add(), ast.Name("a", ast.Load()))
+    return expression
+
+
+def sub_chain(count: int):
+    expression = ast.Name("a", ast.Load())
+    for _ in range(count):
+        expression = ast.BinOp(expression, ast.Sub(), ast.Name("a", ast.Load()))
+    return expression
+
+
+def attribute_chain(count: int):
+    expression = ast.Name("a", ast.Load())
+    for i in range(count):
+        expression = ast.Attribute(expression, f"b{i}", ast.Load())
+    return expression
+
+
+def call_chain(count: int):
+    expression = ast.Name("a", ast.Load())
+    for _ in range(count):
+        expression = ast.Call(ast.Attribute(expression, "f", ast.Load()), [], [])
+    return expression
+
+
+@pytest.mark.parametrize("expression, node, count", [
+    (sub_chain(20000), "BinOp", 20000),
+    # the whole chain is expanded by _attribute_parts as a single node
+    (attribute_chain(20000), "Attribute", 1),
+    (call_chain(5000), "Call", 5000),
+])
+def test_profile_deep_expressions(expression, node, count):
+    profiler = Profiler()
+    lua = Transpiler(profiler=profiler).transpile_ast(deep_tree(expression))
+    assert lua == Transpiler().transpile_ast(deep_tree(expression))
+    assert profiler.nodes[node][0] == count
+    assert profiler.max_depth >= count
+    assert profiler.depth == 0
+
+
+def test_profile_counts_bytes_per_function():
+    source = 'def greet():\n    print("h\u00e9llo w\u00f6rld \u2603")\n\n\ndef main():\n    greet()\n'
+    profiler = Profiler()
+    lua = Transpiler(all_definitions=True, profiler=profiler).transpile(source)
+    start = lua.index("function greet")
+    function = lua[start:lua.index("end\n", start) + len("end\n")]
+    assert profiler.functions["greet"] == len(function.encode("utf-8")) > len(function)
+    assert f"{profiler.functions['greet']:>10} bytes" in profiler.report()
+
+
+def test_instrument_counts_calls_and_exits():
+    source = """def main():
+    def double(x):
+        return x * 2
+
+    def guarded(x):
+        try:
+            return x
+        except Exception:
+            pass
+
+    double(1)
+    double(2)
+    guarded(3)
+"""
+    lua = Transpiler(instrument=True).transpile(source)
+    records = set()
+    # the report is printed as one string, a line per function
+    for line in "\n".join(execute(lua + "\n__profile_dump()\n")).splitlines():
+        name, _, lineno, calls, _, exits, _ = line.split()[:7]
+        records.add((name, int(lineno), int(calls), int(exits)))
+    # the return inside the pcall closure does not count a second exit of guarded
+    assert records == {("double", 2, 2, 2), ("guarded", 5, 1, 1)}
+
+
+@pytest.mark.parametrize("options", [{}, {"optimize": True}, {"minify": True, "pool_strings": True}])
+def test_source_map_lookup(options):
+    source_map = SourceMap(["program.py"])
+    lua = Transpiler(**options).transpile(PROGRAM, source_map=source_map)
+    python_lines = PROGRAM.splitlines()
+    for text in ('"basket"', '"box"'):
+        location = source_map.lookup(lua_line(lua, text))
+        assert location is not None
+        source, line, _ = location
+        assert source == "program.py"
+        assert text in python_lines[line - 1]
+
+
+def test_source_map_round_trip(tmp_path):
+    source_map = SourceMap(["program.py"], file="program.lua")
+    lua = Transpiler().transpile(PROGRAM, source_map=source_map)
+    path = str(tmp_path / "program.lua.map")
+    source_map.save(path)
+    loaded = SourceMap.load(path)
+    assert loaded.encode() == source_map.encode()
+    for line in range(1, lua.count("\n") + 1):
+        assert loaded.lookup(line) == source_map.lookup(line)
+    line = lua_line(lua, '"basket"')
+    assert f"program.py:{source_map.lookup(line)[1]}" in loaded.translate(f'program.lua:{line}: attempt to call nil')
+
+
+def test_deep_expressions():
+    tree = deep_tree(add_chain(20000), "def main():\n    a = 1\n    x = 0\n    print(x)\n")
+    assert execute(Transpiler().transpile_ast(tree)) == ["20000"]
+
+
+def test_parse_nested_expressions():
+    # every supported version parses a thousand levels
+    source = "def main():\n    a = 1\n    print(" + "+".join(["a"] * 1000) + ")\n"
+    assert execute(Transpiler().transpile(source)) == ["1000"]
+
+
+@pytest.mark.skipif(sys.version_info >= (3, 11), reason="3.11 and later have a nesting limit")
+def test_parse_deep_expressions():
+    assert isinstance(parse_source("def main():\n    x = " + "+".join(["a"] * 300000) + "\n"), ast.Module)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11), reason="3.9 and 3.10 only run out of stack")
+def test_too_deep_expressions_raise(monkeypatch):
+    def fail(limit):
+        raise AssertionError("the recursion limit is process wide")
+    monkeypatch.setattr(sys, "setrecursionlimit", fail)
+    with pytest.raises(RecursionError):
+        parse_source("def main():\n    x = " + "+".join(["a"] * 20000) + "\n")
+
+
+def test_accumulator_read_by_closure():
+    source = '''
+def main():
+    s = ""
+    @local
+    def show():
+        print(s)
+    for word in ["x", "y"]:
+        s += word
+        show()
+    t = ""
+    for word in ["x", "y"]:
+        t += word + str(1)
+    print(t)
+'''
+    lua = Transpiler().transpile(source)
+    assert "__s_buffer" not in lua and "__t_buffer" in lua
+    assert execute(lua) == ["x", "xy", "x1y1"]
+
+
+def test_nested_loop_accumulators():
+    source = '''
+def main():
+    @local
+    def build(word: str):
+        text = ""
+        seen = ""
+        @local
+        def peek():
+            return seen
+        for i in range(2):
+            text += word
+            seen += "."
+            for j in range(2):
+                text += "-"
+            print(peek())
+        return text
+    out = ""
+    @local
+    def str(value):
+        return out + "?"
+    out = ""
+    for word in ["a", "b"]:
+        out += str(word)
+    print(build("x"), out)
+'''
+    lua = Transpiler().transpile(source)
+    assert "__text_buffer" in lua
+    # read by a closure, and str is not the builtin
+    assert "__seen_buffer" not in lua and "__out_buffer" not in lua
+    assert execute(lua) == [".", "..", "x--x-- ???"]
+
+
+def test_join_and_format_specs():
+    source = """def main():
+    items = ["a", "b", "c"]
+    sep = "-"
+    value = 3.14159
+    count = 7
+    print(", ".join(items), sep.join(items), "".join(items))
+    print(f"{value:.2f}|{count:5d}|{value:08.3f}|{count!s}|{count:x}|{100}%")
+"""
+    lua = Transpiler().transpile(source)
+    assert lua.count("table.concat(") == 3
+    assert 'string.format("%.2f|%5d|%08.3f|%s|%x|%s%%"' in lua
+    assert execute(lua) == ["a, b, c a-b-c abc", "3.14|    7|0003.142|7|7|100%"]
+
+
+@pytest.mark.parametrize("conversion", ["!r", "!a"])
+def test_quoting_conversions_are_not_supported(conversion):
+    with pytest.raises(NotImplementedError):
+        Transpiler().transpile('def main():\n    name = "w"\n    print(f"{name' + conversion + '}")\n')
+
+
+def test_string_escapes():
+    source = 'def main():\n    a = "x\\x001y"\n    b = "\\x0c\\t\\\\\\"\\x7f"\n    print(string.byte(a, 1, 4))\n    print(string.len(b))\n'
+    assert execute(Transpiler().transpile(source)) == ["120 0 49 121", "5"]